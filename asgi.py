@@ -0,0 +1,426 @@
+# 非同期（ASGI）版のエントリポイント
+# LLM の応答待ちの間もほかの会話を処理できるように、DB・Redis・LINE への通信をすべて非同期で行う
+# 起動例: uvicorn asgi:app --host 0.0.0.0 --port $PORT
+import asyncio
+import functools
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from uuid import uuid4
+
+import aiohttp
+import asyncpg
+import redis.asyncio as aioredis
+import stripe
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage
+from redis.exceptions import LockError
+
+import main
+from main import handler, logger
+
+LINE_MESSAGE_API_URL = "https://api.line.me/v2/bot/message"
+
+db_pool = None
+redis_client = None
+http_session = None
+_append_history_script = None
+_reply_log_count_script = None
+_reply_log_rebuild_script = None
+_reply_log_record_script = None
+_background_tasks = set()
+# 同時に処理するユーザー（会話）の数の上限。スレッドを使わないので、同期版の WEBHOOK_FANOUT_THREADS よりずっと大きくできる
+ASGI_MAX_CONVERSATIONS = int(os.environ.get("ASGI_MAX_CONVERSATIONS", 500))
+_event_slots = asyncio.Semaphore(ASGI_MAX_CONVERSATIONS)
+
+# main.timed の非同期関数用のデコレータ（同じ stage_seconds:{stage} に記録する）
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with main.timed(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@asynccontextmanager
+async def lifespan(app):
+    global db_pool, redis_client, http_session, _append_history_script
+    global _reply_log_count_script, _reply_log_rebuild_script, _reply_log_record_script
+    db_pool = await asyncpg.create_pool(min_size=main.DB_POOL_MIN_SIZE, max_size=main.DB_POOL_MAX_SIZE,
+                                        max_inactive_connection_lifetime=main.DB_POOL_MAX_LIFETIME, **main.db_config)
+    # 同期版と同じ上限とタイムアウトのプールを使う
+    redis_client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+        connection_class=aioredis.SSLConnection if main.url.scheme == "rediss" else aioredis.Connection,
+        max_connections=main.REDIS_MAX_CONNECTIONS,
+        timeout=main.REDIS_POOL_TIMEOUT,
+        **main.redis_connection_kwargs()
+    ))
+    _append_history_script = redis_client.register_script(main._append_history_script.script)
+    _reply_log_count_script = redis_client.register_script(main.REPLY_LOG_COUNT_SCRIPT)
+    _reply_log_rebuild_script = redis_client.register_script(main.REPLY_LOG_REBUILD_SCRIPT)
+    _reply_log_record_script = redis_client.register_script(main.REPLY_LOG_RECORD_SCRIPT)
+    http_session = aiohttp.ClientSession(headers={"Authorization": f"Bearer {main.YOUR_CHANNEL_ACCESS_TOKEN}"})
+    try:
+        yield
+    finally:
+        await http_session.close()
+        await redis_client.close()
+        await db_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.get("/", response_class=PlainTextResponse)
+async def hello_world():
+    return "hello world!"
+
+@app.get("/ready", response_class=PlainTextResponse)
+async def ready():
+    # 同期版の /ready と同じく、依存先に繋がるかを確かめてチェーンも作っておく
+    try:
+        await redis_client.ping()
+        await db_pool.fetchval("SELECT 1")
+        await asyncio.to_thread(main.get_full_chain)
+        await asyncio.to_thread(main.get_summary_chain)
+    except Exception as e:
+        logger.warning(f"Not ready: {e}")
+        return PlainTextResponse("not ready", status_code=503)
+    return "ready"
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(main.render_prometheus_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.post("/callback", response_class=PlainTextResponse)
+async def callback(request: Request):
+    signature = request.headers.get('X-Line-Signature', '')
+    body = (await request.body()).decode('utf-8')
+    try:
+        events = handler.parser.parse(body, signature)
+    except InvalidSignatureError:
+        return PlainTextResponse("Invalid signature", status_code=400)
+
+    # 返信は reply API で非同期に送るので、処理の完了を待たずに200を返す
+    # ユーザーごとに1つのタスクにまとめ、同じユーザーのイベントは届いた順に処理する
+    groups = {}
+    for event in events:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+            userId = getattr(event.source, 'user_id', None)
+            groups.setdefault(userId or id(event), []).append(event)
+    for group in groups.values():
+        task = asyncio.create_task(dispatch_line_events(group))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return 'OK'
+
+@app.post("/stripe/webhook", response_class=PlainTextResponse)
+async def stripe_webhook(request: Request):
+    # 同期版と同じく、Stripe のイベントでサブスクリプションの索引をすぐに更新する
+    if not main.STRIPE_WEBHOOK_SECRET:
+        return PlainTextResponse("Not Found", status_code=404)
+    payload = await request.body()
+    signature = request.headers.get('Stripe-Signature', '')
+    try:
+        event = stripe.Webhook.construct_event(payload, signature, main.STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.SignatureVerificationError):
+        return PlainTextResponse("Invalid signature", status_code=400)
+    # 索引の更新は同期の Redis クライアントを使うので、スレッドに逃がす
+    await asyncio.to_thread(main.apply_subscription_event, event)
+    return 'OK'
+
+async def dispatch_line_events(events):
+    # 上限を超えた分は空きが出るまで待つ（DB や Redis のプールを使い切らないように）
+    async with _event_slots:
+        for event in events:
+            await dispatch_line_event(event)
+
+@timed("send_reply")
+async def send_reply(event, reply_text):
+    messages = [{"type": "text", "text": reply_text}]
+    async with http_session.post(f"{LINE_MESSAGE_API_URL}/reply",
+                                 json={"replyToken": event.reply_token, "messages": messages}) as resp:
+        if resp.status < 400:
+            return
+        user_id = getattr(event.source, 'user_id', None)
+        if resp.status != 400 or not user_id:
+            resp.raise_for_status()
+        logger.info(f"Reply token rejected, falling back to push: {await resp.text()}")
+    async with http_session.post(f"{LINE_MESSAGE_API_URL}/push",
+                                 json={"to": user_id, "messages": messages}) as resp:
+        resp.raise_for_status()
+
+@timed("get_user_state")
+async def get_user_state(user_id):
+    state = await redis_client.get(f"user_state:{user_id}")
+    return state.decode('utf-8') if state else 'normal'
+
+async def set_user_state(user_id, state):
+    await redis_client.set(f"user_state:{user_id}", state, ex=main.USER_STATE_TTL)
+
+@timed("get_subscription_details_for_user")
+async def get_subscription_details_for_user(userId):
+    key = main._subscription_index_key(main.STRIPE_PRICE_ID)
+    if not await redis_client.exists(f"{key}:fresh"):
+        # 索引の作り直しは Stripe の同期クライアントを使うので、スレッドに逃がす
+        if not await asyncio.to_thread(main._ensure_subscription_index, main.STRIPE_PRICE_ID):
+            return await asyncio.to_thread(main._find_subscription_in_stripe, userId, main.STRIPE_PRICE_ID)
+    return main._subscription_details(await redis_client.hget(key, userId))
+
+# 同期版の main.load_message_context と同じく、1件のメッセージで読む Redis のキーを1回のパイプラインで読む
+@timed("load_message_context")
+async def load_message_context(userId):
+    subscription_key = main._subscription_index_key(main.STRIPE_PRICE_ID)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(f"user_state:{userId}")
+            pipe.exists(f"{subscription_key}:fresh")
+            pipe.hget(subscription_key, userId)
+            main.queue_reply_log_count(pipe, userId, time.time())
+            pipe.lrange(f"chat_history:{userId}", 0, -1)
+            pipe.get(f"conversation_summary:{userId}")
+            state, subscription_fresh, subscription, reply_log_exists, _, reply_count, history, summary = await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to load message context: {e}")
+        return {}
+
+    context = {"state": state.decode('utf-8') if state else 'normal'}
+    if subscription_fresh:
+        context["subscription"] = main._subscription_details(subscription)
+    if reply_log_exists:
+        context["reply_count"] = reply_count
+    if history:
+        context["history"] = [json.loads(item) for item in history]
+    if summary is not None:
+        context["summary"] = summary.decode('utf-8')
+    return context
+
+async def _from_context(context, key, load):
+    return context[key] if key in context else await load()
+
+@timed("get_session_history")
+async def load_history_messages(userId):
+    key = f"chat_history:{userId}"
+    items = await redis_client.lrange(key, 0, -1)
+    if items:
+        return [json.loads(item) for item in items]
+
+    rows = await db_pool.fetch(
+        'SELECT sender, message FROM line_bot_logs WHERE Lineid = $1 AND is_active = TRUE ORDER BY id DESC LIMIT $2',
+        userId, main.HISTORY_LIMIT)
+    messages = [main._message_from_row(row['sender'], row['message']) for row in reversed(rows)]
+    if messages:
+        async with redis_client.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+            pipe.expire(key, main.HISTORY_CACHE_TTL)
+            await pipe.execute()
+    return messages
+
+async def load_conversation_summary(userId):
+    key = f"conversation_summary:{userId}"
+    cached = await redis_client.get(key)
+    if cached is not None:
+        return cached.decode('utf-8')
+    summary = await db_pool.fetchval('SELECT summary FROM conversation_summaries WHERE lineId = $1', userId) or ""
+    await redis_client.set(key, summary, ex=main.HISTORY_CACHE_TTL)
+    return summary
+
+async def get_prompt_id(conn, sys_prompt):
+    digest = main.prompt_hash(sys_prompt)
+    prompt_id = main._prompt_ids.get(digest)
+    if prompt_id is None:
+        prompt_id = await conn.fetchval(
+            """
+            INSERT INTO prompts (hash, content) VALUES ($1, $2)
+            ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash
+            RETURNING id;
+            """,
+            digest, sys_prompt)
+    return digest, prompt_id
+
+@timed("log_to_database")
+async def log_to_database(timestamp, sender, userId, stripeId, message, sys_prompt, model_name=None, is_active=True):
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                digest, prompt_id = await get_prompt_id(conn, sys_prompt) if sys_prompt else (None, None)
+                await conn.execute(
+                    """
+                    INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, prompt_id, model)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8);
+                    """,
+                    timestamp, sender, userId, stripeId, message, is_active, prompt_id, model_name)
+        if digest:
+            main._prompt_ids[digest] = prompt_id
+        if is_active:
+            message_json = json.dumps(main._message_from_row(sender, message), ensure_ascii=False)
+            await _append_history_script(keys=[f"chat_history:{userId}", main._summary_pending_key(userId)], args=[message_json, main.HISTORY_LIMIT, main.HISTORY_CACHE_TTL])
+    except Exception as e:
+        print(f"Error: {e}")
+
+async def get_system_responses_in_last_24_hours(userId):
+    key = main._reply_log_key(userId)
+    now = time.time()
+    try:
+        count = await _reply_log_count_script(keys=[key], args=[now, main.RATE_LIMIT_WINDOW_SECONDS])
+        if count < 0:
+            main.increment_metric("reply_log_rebuilds")
+            rows = await db_pool.fetch(main.REPLY_LOG_ROWS_QUERY.replace('%s', '$1'), userId)
+            await _reply_log_rebuild_script(keys=[key], args=main.reply_log_entries(rows, now))
+            count = await _reply_log_count_script(keys=[key], args=[now, main.RATE_LIMIT_WINDOW_SECONDS])
+        return count
+    except Exception as e:
+        # 同期版と同じく、Redis が使えないときは DB で数える（0 を返すと無料枠の上限が効かなくなる）
+        logger.warning(f"Failed to read reply log from Redis, counting in the database: {e}")
+        return await count_system_responses_in_db(userId)
+
+async def count_system_responses_in_db(userId):
+    try:
+        return await db_pool.fetchval(
+            """
+            SELECT COUNT(*) FROM line_bot_logs
+            WHERE sender='system' AND lineId=$1 AND timestamp > NOW() - INTERVAL '24 HOURS';
+            """,
+            userId)
+    except Exception as e:
+        print(f"Error: {e}")
+        return 0
+
+async def record_system_response(userId):
+    key = main._reply_log_key(userId)
+    try:
+        await _reply_log_record_script(keys=[key], args=[time.time(), uuid4().hex, main.RATE_LIMIT_WINDOW_SECONDS])
+    except Exception as e:
+        logger.warning(f"Failed to record reply: {e}")
+        await redis_client.delete(key)
+
+async def deactivate_conversation_history(userId):
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("UPDATE line_bot_logs SET is_active=FALSE WHERE lineId=$1 AND is_active=TRUE;", userId)
+                await conn.execute("DELETE FROM conversation_summaries WHERE lineId=$1;", userId)
+        await redis_client.delete(f"chat_history:{userId}", f"conversation_summary:{userId}", main._summary_pending_key(userId))
+        await set_user_state(userId, 'normal')
+    except Exception as e:
+        print(f"Error: {e}")
+
+async def claim_webhook_event(event):
+    key = main.webhook_event_key(event)
+    if key is None:
+        return True
+    try:
+        claimed = bool(await redis_client.set(key, 1, nx=True, ex=main.WEBHOOK_DEDUPE_TTL))
+    except Exception as e:
+        logger.warning(f"Failed to check webhook event: {e}")
+        return True
+    main.record_webhook_delivery(event, claimed)
+    return claimed
+
+async def dispatch_line_event(event):
+    # 同期版と同じキーで再送を見分けて、DB やモデルを使う前に捨てる
+    if not await claim_webhook_event(event):
+        return
+    userId = getattr(event.source, 'user_id', None)
+    try:
+        if not userId:
+            await handle_line_message(event)
+            return
+        # 同期版と同じ Redis のロックで、同じユーザーのメッセージを1件ずつ処理する
+        lock = redis_client.lock(f"user_lock:{userId}", timeout=main.USER_LOCK_TIMEOUT, blocking_timeout=main.USER_LOCK_TIMEOUT)
+        acquired = await lock.acquire()
+        if not acquired:
+            logger.warning(f"Timed out waiting for user lock, processing anyway: {userId}")
+        try:
+            await handle_line_message(event)
+        finally:
+            if acquired:
+                try:
+                    await lock.release()
+                except LockError:
+                    pass
+    except Exception:
+        logger.exception("Failed to handle LINE event")
+        # 処理できなかったイベントは、再送されたときにやり直せるようにする
+        key = main.webhook_event_key(event)
+        if key:
+            try:
+                await redis_client.delete(key)
+            except Exception as e:
+                logger.warning(f"Failed to release webhook event: {e}")
+
+@timed("handle_line_message")
+async def handle_line_message(event):
+    userId = getattr(event.source, 'user_id', None)
+    text = event.message.text
+
+    if not userId:
+        await send_reply(event, "エラーが発生しました。")
+        return
+
+    context = await load_message_context(userId)
+    current_state = await _from_context(context, "state", lambda: get_user_state(userId))
+
+    # ユーザーが「リセット」を送信した場合
+    if text == "リセット":
+        await set_user_state(userId, 'awaiting_reset_confirmation')
+        reply_text = "過去の対話履歴を削除して良いですか？一度削除すると元には戻せません。よろしければ「はい」と入力してください。"
+        await send_reply(event, reply_text)
+        return
+
+    # ユーザーが「はい」を送信した場合、リセット確認状態なら履歴を削除
+    elif current_state == 'awaiting_reset_confirmation':
+        if text.lower() == "はい":
+            await deactivate_conversation_history(userId)
+            reply_text = "対話履歴を削除しました。"
+        else:
+            reply_text = "対話履歴の削除を中止しました。"
+        await set_user_state(userId, 'normal')
+        await send_reply(event, reply_text)
+        return
+
+    # 通常のメッセージ処理
+    current_timestamp = datetime.now()
+    subscription_details, history, summary = await asyncio.gather(
+        _from_context(context, "subscription", lambda: get_subscription_details_for_user(userId)),
+        _from_context(context, "history", lambda: load_history_messages(userId)),
+        _from_context(context, "summary", lambda: load_conversation_summary(userId)),
+    )
+    stripe_id = subscription_details['stripeId'] if subscription_details else None
+    subscription_status = subscription_details['status'] if subscription_details else None
+
+    with main.request_history_scope():
+        # チェーンの中の get_session_history が DB を読まないように、履歴を先にキャッシュへ入れておく
+        main._request_history.get()[userId] = history
+        main._request_history.get()[("summary", userId)] = summary
+
+        result = None
+        if subscription_status == None: ####################本番は"active", テストはNone################
+            result = await main.agenerate_claude_response(text, userId)
+        else:
+            response_count = await _from_context(context, "reply_count", lambda: get_system_responses_in_last_24_hours(userId))
+            if response_count < 5:
+                result = await main.agenerate_claude_response(text, userId)
+            else:
+                line_login_url = os.environ["LINE_LOGIN_URL"]
+                reply_text = f"利用回数の上限に達しました。24時間後に再度お試しください。こちらから回数無制限の有料プランに申し込むこともできます：{line_login_url}"
+
+    # 返信を先に送り、ログの保存はその後に行う
+    if result:
+        reply_text = main.extract_reply_text(result["response"])
+    try:
+        await send_reply(event, reply_text)
+    finally:
+        # メッセージをログに保存（返信に失敗しても記録は残す）
+        sys_prompt = result["sys_prompt"] if result else None
+        response_model = result.get("model", main.model_name) if result else main.model_name
+        await log_to_database(current_timestamp, 'user', userId, stripe_id, text, sys_prompt, response_model, True)
+        if result:
+            await log_to_database(current_timestamp, 'system', userId, stripe_id, result["response"], sys_prompt, response_model, True)
+            await record_system_response(userId)
+
+    main.schedule_summary_update(userId)
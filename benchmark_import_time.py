@@ -0,0 +1,76 @@
+# main.py の import にかかる時間を測り、起動時間の予算を超えていないかを確かめる
+# python -X importtime の出力をパッケージごとに集計し、遅いものから表示する
+# 実行例: python benchmark_import_time.py --runs 5 --budget-ms 1500
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# import 時に読む環境変数。未設定ならダミーの値を入れる（import の時点ではどこにも接続しない）
+REQUIRED_ENV = {
+    "YOUR_CHANNEL_ACCESS_TOKEN": "dummy",
+    "YOUR_CHANNEL_SECRET": "dummy",
+    "OPENAI_API_KEY": "dummy",
+    "ANTHROPIC_API_KEY": "dummy",
+    "GOOGLE_API_KEY": "dummy",
+    "STRIPE_SECRET_KEY": "dummy",
+    "SUBSCRIPTION_PRICE_ID": "dummy",
+    "DB_HOST": "localhost",
+    "DB_USER": "dummy",
+    "DB_PASS": "dummy",
+    "DB_NAME": "dummy",
+    "REDIS_URL": "redis://localhost:6379",
+}
+
+def child_env():
+    env = dict(os.environ)
+    for key, value in REQUIRED_ENV.items():
+        env.setdefault(key, value)
+    return env
+
+def import_wall_time(module, env):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], env=env, check=True)
+    return (time.perf_counter() - started) * 1000
+
+def import_breakdown(module, env):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            env=env, check=True, capture_output=True, text=True)
+    totals = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # 入れ子の import は字下げされている。最上位の import だけを数えれば二重に数えない
+        if name[1:].startswith(" "):
+            continue
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + int(cumulative) / 1000
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--budget-ms", type=float, default=float(os.environ.get("IMPORT_BUDGET_MS", 1500)))
+    args = parser.parse_args()
+
+    env = child_env()
+    # インタプリタ自体の起動時間を差し引く
+    baseline = statistics.median(import_wall_time("sys", env) for _ in range(args.runs))
+    timings = [import_wall_time(args.module, env) - baseline for _ in range(args.runs)]
+    median = statistics.median(timings)
+
+    totals = import_breakdown(args.module, env)
+    print(f"{'package':<32}{'cumulative ms':>14}")
+    for package, ms in sorted(totals.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{package:<32}{ms:>14.1f}")
+    print(f"\nimport {args.module}: median {median:.0f} ms over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    if median > args.budget_ms:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
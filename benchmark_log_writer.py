@@ -0,0 +1,79 @@
+# line_bot_logs への書き込みについて、1行ずつ INSERT してコミットする方法と、まとめて書き出す方法の速さを比べる
+# 使い捨ての benchmark スキーマに create_tables.py のマイグレーションで同じ表を作って測る
+# 実行例: DATABASE_URL=postgres://... PGSSLMODE=disable python benchmark_log_writer.py --rows 20000 --batch-size 50
+import argparse
+import os
+import time
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import create_tables
+
+SCHEMA = "benchmark"
+
+INSERT_ROW = """
+INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, prompt_id, model) 
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+"""
+
+INSERT_BATCH = """
+INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, prompt_id, model) 
+VALUES %s;
+"""
+
+def make_rows(count, users):
+    now = datetime.now()
+    return [(now, "user" if i % 2 == 0 else "system", f"U{(i // 2) % users:032x}", None,
+             "相談の内容です。" * 10, True, None, "gpt-4o-2024-08-06")
+            for i in range(count)]
+
+def per_row(conn, cur, rows, batch_size):
+    for row in rows:
+        cur.execute(INSERT_ROW, row)
+        conn.commit()
+
+def batched(conn, cur, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        execute_values(cur, INSERT_BATCH, rows[start:start + batch_size], page_size=batch_size)
+        conn.commit()
+
+def run(conn, cur, label, write, rows, batch_size):
+    cur.execute("TRUNCATE line_bot_logs")
+    conn.commit()
+    started = time.perf_counter()
+    write(conn, cur, rows, batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"{label}: {len(rows)} rows in {elapsed:.2f}s ({len(rows) / elapsed:.0f} rows/s)")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], sslmode=os.environ.get("PGSSLMODE", "require"))
+    cur = conn.cursor()
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"SET search_path TO {SCHEMA}")
+        create_tables.create_line_bot_logs(cur, conn)
+        create_tables.create_prompts(cur, conn)
+        create_tables.add_model_column(cur, conn)
+        conn.commit()
+
+        rows = make_rows(args.rows, args.users)
+        run(conn, cur, "per-row INSERT", per_row, rows, args.batch_size)
+        run(conn, cur, f"batched INSERT ({args.batch_size} rows)", batched, rows, args.batch_size)
+    finally:
+        conn.rollback()
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+        cur.close()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# line_bot_logs のよく使うクエリについて、インデックスの有無で実行計画と応答時間を比べる
+# 使い捨ての benchmark スキーマに大量の行を生成し、create_tables.py のマイグレーションで同じ表とインデックスを作る
+# 実行例: DATABASE_URL=postgres://... PGSSLMODE=disable python benchmark_queries.py --rows 3000000 --users 20000
+import argparse
+import os
+import random
+import statistics
+import time
+
+import psycopg2
+
+import create_tables
+
+SCHEMA = "benchmark"
+
+QUERIES = {
+    "history": (
+        "SELECT sender, message FROM line_bot_logs WHERE Lineid = %s AND is_active = TRUE ORDER BY id DESC LIMIT 41",
+        False),
+    "system_count_24h": (
+        "SELECT COUNT(*) FROM line_bot_logs WHERE sender='system' AND lineId=%s AND timestamp > NOW() - INTERVAL '24 HOURS'",
+        False),
+    # 書き込むクエリは ROLLBACK して、測定ごとにデータが変わらないようにする
+    "deactivate": (
+        "UPDATE line_bot_logs SET is_active=FALSE WHERE lineId=%s AND is_active=TRUE",
+        True),
+}
+
+def user_id(n):
+    return f"U{n:032x}"
+
+def populate(cur, rows, users):
+    create_tables.create_line_bot_logs(cur, None)
+    create_tables.add_model_column(cur, None)
+    # 1人のユーザーの発言と返信が交互に並び、時刻は90日間に均等に散らばるようにする
+    cur.execute("""
+        INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, model)
+        SELECT NOW() - INTERVAL '90 days' + g * (INTERVAL '90 days' / %(rows)s),
+               CASE WHEN g %% 2 = 0 THEN 'user' ELSE 'system' END,
+               'U' || lpad(to_hex((g / 2) %% %(users)s), 32, '0'),
+               NULL,
+               repeat('相談の内容です。', 10),
+               random() > 0.2,
+               'gpt-4o-2024-08-06'
+        FROM generate_series(1, %(rows)s) AS g
+    """, {"rows": rows, "users": users})
+    cur.execute("ANALYZE line_bot_logs")
+
+def explain(cur, sql, params, rollback):
+    if rollback:
+        cur.execute("BEGIN")
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    if rollback:
+        cur.execute("ROLLBACK")
+    return plan
+
+def measure(cur, sql, rollback, users, samples):
+    timings = []
+    for _ in range(samples):
+        params = (user_id(random.randrange(users)),)
+        if rollback:
+            cur.execute("BEGIN")
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        if cur.description:
+            cur.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+        if rollback:
+            cur.execute("ROLLBACK")
+    timings.sort()
+    return statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+
+def report(cur, label, users, samples):
+    print(f"===== {label} =====")
+    for name, (sql, rollback) in QUERIES.items():
+        print(f"--- {name}")
+        print(explain(cur, sql, (user_id(42 % users),), rollback))
+        p50, p95 = measure(cur, sql, rollback, users, samples)
+        print(f"p50 {p50:.2f} ms / p95 {p95:.2f} ms over {samples} users\n")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=3_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--keep", action="store_true", help="終わった後も benchmark スキーマを消さない")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], sslmode=os.environ.get("PGSSLMODE", "require"))
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"SET search_path TO {SCHEMA}")
+        started = time.perf_counter()
+        populate(cur, args.rows, args.users)
+        print(f"Generated {args.rows} rows for {args.users} users in {time.perf_counter() - started:.1f}s\n")
+
+        report(cur, "primary key only", args.users, args.samples)
+        started = time.perf_counter()
+        create_tables.create_line_bot_logs_indexes(cur, conn)
+        print(f"Built indexes in {time.perf_counter() - started:.1f}s\n")
+        report(cur, "with indexes", args.users, args.samples)
+    finally:
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.close()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# ResponseModelRouter をローカルの Fake チャットモデルだけで動かし、切り替えの振る舞いを確かめる
+# フェイルオーバー・サーキットブレーカーの遮断と再試行（half-open）・ヘッジング・ストリームを途中で閉じた場合を調べる
+# API キーも外部への接続も要らない
+# 実行例: python check_response_router.py
+import asyncio
+import os
+import sys
+import time
+
+from benchmark_import_time import REQUIRED_ENV
+
+for key, value in REQUIRED_ENV.items():
+    os.environ.setdefault(key, value)
+# 遮断から再試行までを待たずに確かめられるよう、しきい値と待ち時間を小さくしてから import する
+os.environ["CIRCUIT_FAILURE_THRESHOLD"] = "2"
+os.environ["CIRCUIT_RESET_SECONDS"] = "0.2"
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+import main as app
+
+class ScriptedChatModel(FakeListChatModel):
+    """呼ばれた回数を数え、fail が立っていれば失敗し、delay 秒かけて返す Fake モデル"""
+
+    fail: bool = False
+    delay: float = 0.0
+    calls: int = 0
+
+    def _call(self, *args, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("provider unavailable")
+        return super()._call(*args, **kwargs)
+
+    def _stream(self, *args, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("provider unavailable")
+        yield from super()._stream(*args, **kwargs)
+
+def make_router(providers, **kwargs):
+    return app.ResponseModelRouter(providers, **kwargs)
+
+def check_failover():
+    primary = ScriptedChatModel(responses=["primary"], fail=True)
+    fallback = ScriptedChatModel(responses=["fallback"])
+    router = make_router([("failover-primary", primary), ("failover-fallback", fallback)])
+    result = router.invoke("hello")
+    assert result.content == "fallback", result.content
+    assert result.response_metadata["response_model"] == "failover-fallback"
+    assert app.get_metrics().get("response_model_failures:failover-primary") == 1
+
+def check_async_failover():
+    primary = ScriptedChatModel(responses=["primary"], fail=True)
+    fallback = ScriptedChatModel(responses=["fallback"])
+    router = make_router([("afailover-primary", primary), ("afailover-fallback", fallback)])
+    result = asyncio.run(router.ainvoke("hello"))
+    assert result.content == "fallback", result.content
+
+def check_breaker():
+    primary = ScriptedChatModel(responses=["primary"], fail=True)
+    fallback = ScriptedChatModel(responses=["fallback"])
+    router = make_router([("breaker-primary", primary), ("breaker-fallback", fallback)])
+    breaker = router.providers[0][2]
+
+    # しきい値まで失敗すると遮断され、以降は優先プロバイダを呼ばない
+    for _ in range(breaker.failure_threshold):
+        router.invoke("hello")
+    assert breaker.opened_at is not None
+    calls = primary.calls
+    assert router.invoke("hello").content == "fallback"
+    assert primary.calls == calls, "open breaker should skip the provider"
+
+    # 待ち時間が過ぎたら1回だけ試す。また失敗したらすぐに遮断し直す
+    time.sleep(breaker.reset_seconds)
+    router.invoke("hello")
+    assert primary.calls == calls + 1
+    assert not breaker.allow(), "failed half-open attempt should re-open the breaker"
+
+    # 回復していれば成功で遮断が解ける
+    time.sleep(breaker.reset_seconds)
+    primary.fail = False
+    assert router.invoke("hello").content == "primary"
+    assert breaker.opened_at is None and breaker.failures == 0
+
+def check_hedging():
+    slow = ScriptedChatModel(responses=["slow"], delay=1.0)
+    fast = ScriptedChatModel(responses=["fast"])
+    router = make_router([("hedge-slow", slow), ("hedge-fast", fast)], hedging=True, hedge_default_delay=0.1)
+    hedged = app.get_metrics().get("response_model_hedged", 0)
+    started = time.perf_counter()
+    result = router.invoke("hello")
+    elapsed = time.perf_counter() - started
+    assert result.content == "fast", result.content
+    assert elapsed < slow.delay, f"hedged call took {elapsed:.2f}s"
+    assert app.get_metrics().get("response_model_hedged") == hedged + 1
+
+def check_stream_closed_early():
+    model = ScriptedChatModel(responses=["<response>ok</response> trailing text"])
+    router = make_router([("stream-primary", model)])
+    breaker = router.providers[0][2]
+    breaker.failures = 1
+    # STREAM_RESPONSES=true のときと同じく、最初の数チャンクだけ読んで閉じる
+    stream = router.stream("hello")
+    next(stream)
+    stream.close()
+    assert breaker.failures == 0, "closing the stream should count as success"
+    assert app.get_metrics().get("response_model_seconds:stream-primary", {}).get("count") == 1
+
+def check_stream_failover():
+    primary = ScriptedChatModel(responses=["primary"], fail=True)
+    fallback = ScriptedChatModel(responses=["fallback"])
+    router = make_router([("sfailover-primary", primary), ("sfailover-fallback", fallback)])
+    chunks = list(router.stream("hello"))
+    text = "".join(chunk.content for chunk in chunks)
+    assert text == "fallback", text
+    assert chunks[0].response_metadata["response_model"] == "sfailover-fallback"
+
+CHECKS = [
+    check_failover,
+    check_async_failover,
+    check_breaker,
+    check_hedging,
+    check_stream_closed_early,
+    check_stream_failover,
+]
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL {check.__name__}: {e}")
+        else:
+            print(f"ok   {check.__name__}")
+    print(f"{len(CHECKS) - failed}/{len(CHECKS)} checks passed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,42 +1,171 @@
 import os
+import sys
 import psycopg2
 
 DATABASE_URL = os.environ['DATABASE_URL']
 
-def table_exists(cur, table_name):
+# スキーマの変更はバージョン付きのマイグレーションとして末尾に追加していく
+# 適用済みのバージョンは schema_migrations に記録し、release のたびに未適用のものだけを実行する
+# 各マイグレーションは IF NOT EXISTS などで書き、schema_migrations ができる前のDBに対しても安全に流せるようにする
+MIGRATION_LOCK_ID = 20240801
+
+def create_line_bot_logs(cur, conn):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS line_bot_logs (
+            id SERIAL PRIMARY KEY,
+            timestamp TIMESTAMP,
+            sender VARCHAR(255),
+            lineId VARCHAR(255),
+            stripeId VARCHAR(255),
+            message TEXT,
+            is_active BOOLEAN,
+            sys_prompt TEXT
+        )
+    """)
+
+def create_conversation_summaries(cur, conn):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            lineId VARCHAR(255) PRIMARY KEY,
+            summary TEXT,
+            last_summarized_id INTEGER,
+            updated_at TIMESTAMP
+        )
+    """)
+
+PROMPT_MIGRATION_BATCH_SIZE = 5000
+
+def migrate_sys_prompts(cur, conn):
+    # 既存の行に入っているシステムプロンプトを prompts に移し、同じ内容は1行にまとめる
+    # ハッシュは main.prompt_hash と同じく UTF-8 の SHA-256 の16進表記
+    # 長いロックを避けるため、少しずつ prompt_id に置き換えて本文を消す
+    # トランザクションの外（autocommit）で流すので、1回の INSERT / UPDATE ごとに確定する
+    migrated = 0
+    last_id = 0
+    while True:
+        cur.execute("""
+            SELECT id FROM line_bot_logs
+            WHERE sys_prompt IS NOT NULL AND prompt_id IS NULL AND id > %s
+            ORDER BY id LIMIT %s
+        """, (last_id, PROMPT_MIGRATION_BATCH_SIZE))
+        ids = [row[0] for row in cur.fetchall()]
+        if not ids:
+            break
+        last_id = ids[-1]
+        # 移行の途中で古いコードが書いた行のプロンプトも prompts に入るよう、バッチごとに足してから置き換える
+        cur.execute("""
+            INSERT INTO prompts (hash, content)
+            SELECT DISTINCT encode(sha256(convert_to(sys_prompt, 'UTF8')), 'hex'), sys_prompt
+            FROM line_bot_logs
+            WHERE id = ANY(%s) AND sys_prompt IS NOT NULL
+            ON CONFLICT (hash) DO NOTHING
+        """, (ids,))
+        cur.execute("""
+            UPDATE line_bot_logs l
+            SET prompt_id = p.id, sys_prompt = NULL
+            FROM prompts p
+            WHERE l.id = ANY(%s) AND l.sys_prompt IS NOT NULL
+            AND p.hash = encode(sha256(convert_to(l.sys_prompt, 'UTF8')), 'hex')
+        """, (ids,))
+        migrated += cur.rowcount
+    if migrated:
+        print(f"Moved the system prompt of {migrated} rows into 'prompts'")
+
+def create_prompts(cur, conn):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS prompts (
+            id SERIAL PRIMARY KEY,
+            hash CHAR(64) UNIQUE NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    cur.execute("ALTER TABLE line_bot_logs ADD COLUMN IF NOT EXISTS prompt_id INTEGER REFERENCES prompts(id)")
+    migrate_sys_prompts(cur, conn)
+
+def add_model_column(cur, conn):
+    # log_to_database は以前から model を書き込んでいたが、列を作っていなかった
+    cur.execute("ALTER TABLE line_bot_logs ADD COLUMN IF NOT EXISTS model VARCHAR(255)")
+
+# よく使うクエリのためのインデックス
+# - 履歴の読み込みと要約の対象探し: WHERE lineId = ? AND is_active ORDER BY id DESC LIMIT ?
+# - 24時間以内の返信数: WHERE sender = 'system' AND lineId = ? AND timestamp > ?
+# - 履歴の削除: UPDATE ... WHERE lineId = ? AND is_active
+LINE_BOT_LOGS_INDEXES = {
+    "line_bot_logs_active_history_idx": "ON line_bot_logs (lineId, id DESC) WHERE is_active",
+    "line_bot_logs_system_timestamp_idx": "ON line_bot_logs (lineId, timestamp) WHERE sender = 'system'",
+}
+
+def create_line_bot_logs_indexes(cur, conn):
+    # CONCURRENTLY は書き込みを止めずに作れるが、トランザクションの外でしか実行できない
+    for name, definition in LINE_BOT_LOGS_INDEXES.items():
+        # 途中で失敗した CONCURRENTLY は無効なインデックスを残し、IF NOT EXISTS では作り直されないので先に消す
+        cur.execute("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND NOT i.indisvalid
+        """, (name,))
+        if cur.fetchone():
+            cur.execute(f"DROP INDEX CONCURRENTLY {name}")
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}")
+    cur.execute("ANALYZE line_bot_logs")
+
+# (バージョン, 名前, 関数, トランザクション内で実行するか)
+MIGRATIONS = [
+    (1, "create line_bot_logs", create_line_bot_logs, True),
+    (2, "create conversation_summaries", create_conversation_summaries, True),
+    (3, "move system prompts into prompts", create_prompts, False),
+    (4, "add line_bot_logs.model", add_model_column, True),
+    (5, "index line_bot_logs hot queries", create_line_bot_logs_indexes, False),
+]
+
+def applied_versions(cur):
     cur.execute("""
-        SELECT EXISTS (
-            SELECT FROM information_schema.tables 
-            WHERE table_name = %s
-        );
-    """, (table_name,))
-    return cur.fetchone()[0]
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+def run_migrations(conn, migrations=MIGRATIONS):
+    cur = conn.cursor()
+    conn.autocommit = True
+    # release が同時に走っても二重に適用しないようにする
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    try:
+        applied = applied_versions(cur)
+        for version, name, migrate, transactional in migrations:
+            if version in applied:
+                continue
+            conn.autocommit = not transactional
+            try:
+                migrate(cur, conn)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                if transactional:
+                    conn.commit()
+            except Exception:
+                if transactional:
+                    conn.rollback()
+                raise
+            finally:
+                conn.autocommit = True
+            print(f"Applied migration {version}: {name}")
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        cur.close()
 
 def create_tables():
     conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-    cur = conn.cursor()
     try:
-        if not table_exists(cur, 'line_bot_logs'):
-            cur.execute("""
-                CREATE TABLE line_bot_logs (
-                    id SERIAL PRIMARY KEY,
-                    timestamp TIMESTAMP,
-                    sender VARCHAR(255),
-                    lineId VARCHAR(255),
-                    stripeId VARCHAR(255),
-                    message TEXT,
-                    is_active BOOLEAN,
-                    sys_prompt TEXT
-                )
-            """)
-            conn.commit()
-            print("Table 'line_bot_logs' created successfully")
-        else:
-            print("Table 'line_bot_logs' already exists")
+        run_migrations(conn)
+        print("Schema is up to date")
     except Exception as e:
+        # 失敗したまま release を通すと、古いスキーマのまま新しいコードが起動してしまう
         print(f"An error occurred: {e}")
+        sys.exit(1)
     finally:
-        cur.close()
         conn.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,8 @@
+# gunicorn は起動したディレクトリの gunicorn.conf.py を自動で読み込む
+import sys
+
+def worker_exit(server, worker):
+    # ワーカーが止まる前に、バッファに残っているログを書き出す
+    main = sys.modules.get("main")
+    if main is not None:
+        main.log_writer.close()
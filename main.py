@@ -7,7 +7,7 @@ from linebot import (
     LineBotApi, WebhookHandler
 )
 from linebot.exceptions import (
-    InvalidSignatureError
+    InvalidSignatureError, LineBotApiError
 )
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
@@ -18,21 +18,30 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__) # stripeの情報の確認
 import stripe
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
+import json
+import asyncio
+import hashlib
+import unicodedata
+import threading
+import contextvars
+import time
+import atexit
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 from typing import Dict, Any
-from fastapi import Request
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.runnables import RunnableLambda
-from langchain.schema.runnable.utils import ConfigurableFieldSpec
-from langchain_community.chat_message_histories import ChatMessageHistory
-
-app = Flask(__name__)
+from langchain_core.runnables import Runnable, RunnableLambda, RunnableParallel
+from langchain_core.tracers.context import tracing_v2_enabled
+from langchain_core.runnables.utils import ConfigurableFieldSpec
 
 import redis
 from urllib.parse import urlparse
@@ -41,24 +50,37 @@ from urllib.parse import urlparse
 # Redis クライアントの初期化（グローバルスコープ）
 redis_url = os.environ.get("REDIS_TLS_URL") or os.environ.get("REDIS_URL")
 url = urlparse(redis_url)
-redis_client = redis.Redis(
-    host=url.hostname,
-    port=url.port,
-    password=url.password,
-    ssl=(url.scheme == "rediss"),
-    ssl_cert_reqs=None
+# 接続数に上限のあるプールを使い、空きが無いときは REDIS_POOL_TIMEOUT 秒まで待つ
+# （TLS の接続を作り直すのは遅いので、Webhook のワーカースレッドやバックグラウンド処理と使い回す）
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 20))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get("REDIS_CONNECT_TIMEOUT", 3))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))  # Webhook のキューの BRPOP（1秒）より長くする
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))
+
+def redis_connection_kwargs():
+    kwargs = {
+        "host": url.hostname,
+        "port": url.port,
+        "password": url.password,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_keepalive": True,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+    }
+    if url.scheme == "rediss":
+        kwargs["ssl_cert_reqs"] = None
+    return kwargs
+
+redis_pool = redis.BlockingConnectionPool(
+    connection_class=redis.SSLConnection if url.scheme == "rediss" else redis.Connection,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    **redis_connection_kwargs()
 )
+redis_client = redis.Redis(connection_pool=redis_pool)
 
-# 接続テスト
-try:
-    redis_client.ping()
-    logger.info("Successfully connected to Redis")
-except redis.ConnectionError as e:
-    logger.error(f"Failed to connect to Redis: {e}")
-    raise
-except Exception as e:
-    logger.error(f"Failed to initialize Redis client: {str(e)}")
-    raise
+# 接続の確認は import 時ではなく /ready で行う（ワーカーの起動を待たせないため）
 
 # 環境変数取得
 YOUR_CHANNEL_ACCESS_TOKEN = os.environ["YOUR_CHANNEL_ACCESS_TOKEN"]
@@ -72,35 +94,317 @@ GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
 
 stripe.api_key = os.environ["STRIPE_SECRET_KEY"]
 STRIPE_PRICE_ID = os.environ["SUBSCRIPTION_PRICE_ID"]
+STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET")
+
+# 簡易メトリクス（プロセス単位で集計）
+# 名前は "名前:ラベル" の形にでき、/metrics では 名前{key="ラベル"} として出力する
+_metrics_lock = threading.Lock()
+_metrics = {}
+_metric_samples = {}  # 分位点を出すために直近の値を残しておく
+_counters = {}
+# 名前が _seconds で終わるものは、この区切りのヒストグラムとしても数える
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _is_latency_metric(name):
+    return name.split(":", 1)[0].endswith("_seconds")
+
+def observe_metric(name, value):
+    with _metrics_lock:
+        stat = _metrics.get(name)
+        if stat is None:
+            stat = _metrics[name] = {"count": 0, "sum": 0.0, "max": 0.0}
+            if _is_latency_metric(name):
+                stat["buckets"] = [0] * len(LATENCY_BUCKETS)
+        stat["count"] += 1
+        stat["sum"] += value
+        stat["max"] = max(stat["max"], value)
+        if "buckets" in stat:
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    stat["buckets"][i] += 1
+                    break
+        _metric_samples.setdefault(name, deque(maxlen=1000)).append(value)
+
+# 処理の段階ごとの所要時間を stage_seconds:{stage} に記録する。with 文でもデコレータでも使える
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_metric(f"stage_seconds:{stage}", time.perf_counter() - started)
+
+def increment_metric(name, value=1):
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def get_metric_percentile(name, q):
+    with _metrics_lock:
+        samples = sorted(_metric_samples.get(name, ()))
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+def get_metric_mean(name):
+    with _metrics_lock:
+        stat = _metrics.get(name)
+        return stat["sum"] / stat["count"] if stat else None
+
+def get_metrics():
+    with _metrics_lock:
+        metrics = {name: dict(stat) for name, stat in _metrics.items()}
+        counters = dict(_counters)
+    for name, stat in metrics.items():
+        stat["p50"] = get_metric_percentile(name, 0.5)
+        stat["p95"] = get_metric_percentile(name, 0.95)
+    metrics.update(counters)
+    return metrics
+
+def _prometheus_series(name, suffix="", labels=None):
+    base, _, key = name.partition(":")
+    label_pairs = [("key", key)] if key else []
+    label_pairs += list((labels or {}).items())
+    series = "linebot_" + re.sub(r"[^a-zA-Z0-9_]", "_", base) + suffix
+    if not label_pairs:
+        return series
+    escaped = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                       for k, v in label_pairs)
+    return f"{series}{{{escaped}}}"
+
+def render_prometheus_metrics():
+    """メトリクスを Prometheus のテキスト形式で返す"""
+    with _metrics_lock:
+        metrics = {name: {**stat, "buckets": list(stat.get("buckets", ()))} for name, stat in _metrics.items()}
+        counters = dict(_counters)
+    families = {}
+    for name in sorted(metrics):
+        families.setdefault(name.split(":", 1)[0], []).append(name)
+
+    lines = []
+    for base, names in families.items():
+        if _is_latency_metric(base):
+            lines.append(f"# TYPE {_prometheus_series(base)} histogram")
+            for name in names:
+                stat = metrics[name]
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stat["buckets"]):
+                    cumulative += count
+                    lines.append(f"{_prometheus_series(name, '_bucket', {'le': bound})} {cumulative}")
+                lines.append(f"{_prometheus_series(name, '_bucket', {'le': '+Inf'})} {stat['count']}")
+                lines.append(f"{_prometheus_series(name, '_sum')} {stat['sum']}")
+                lines.append(f"{_prometheus_series(name, '_count')} {stat['count']}")
+        else:
+            lines.append(f"# TYPE {_prometheus_series(base)} summary")
+            for name in names:
+                stat = metrics[name]
+                for q in (0.5, 0.95):
+                    lines.append(f"{_prometheus_series(name, '', {'quantile': q})} {get_metric_percentile(name, q)}")
+                lines.append(f"{_prometheus_series(name, '_sum')} {stat['sum']}")
+                lines.append(f"{_prometheus_series(name, '_count')} {stat['count']}")
+
+    counter_families = {}
+    for name in sorted(counters):
+        counter_families.setdefault(name.split(":", 1)[0], []).append(name)
+    for base, names in counter_families.items():
+        lines.append(f"# TYPE {_prometheus_series(base, '_total')} counter")
+        for name in names:
+            lines.append(f"{_prometheus_series(name, '_total')} {counters[name]}")
+    return "\n".join(lines) + "\n"
+
+# db接続（プロセス内で共有するコネクションプール）
+# gunicorn はワーカーごとに main を import するので、プールもワーカーごとに作られる
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 5))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))  # 空きコネクションを待つ最大秒数
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", 1800))  # この秒数を超えたコネクションは作り直す
+DB_POOL_HEALTHCHECK_IDLE = float(os.environ.get("DB_POOL_HEALTHCHECK_IDLE", 30))  # この秒数以上使われていなければ SELECT 1 で確認
+
+# psycopg2 の ThreadedConnectionPool は minconn 本を超えて返されたコネクションを閉じてしまうので、
+# 空いているコネクションは自前のリストで DB_POOL_MAX_SIZE 本まで持っておく
+_db_pool_lock = threading.Lock()
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)  # 貸し出し中と空きを合わせた上限
+_db_idle = []  # 空いているコネクション（末尾が最後に返されたもの）
+_db_pool_warmed = False
+_db_conn_info = {}  # id(conn) -> {"created": ..., "last_used": ...}
+
+def _open_connection():
+    conn = psycopg2.connect(**db_config)
+    now = time.monotonic()
+    _db_conn_info[id(conn)] = {"created": now, "last_used": now}
+    return conn
+
+def _close_connection(conn):
+    # id は閉じた後に別のコネクションで再利用されうるので、情報も必ず一緒に消す
+    _db_conn_info.pop(id(conn), None)
+    try:
+        conn.close()
+    except Exception as e:
+        logger.warning(f"Failed to close DB connection: {e}")
+
+def _warm_db_pool():
+    # 最初に使うときに DB_POOL_MIN_SIZE 本を開いておく
+    global _db_pool_warmed
+    with _db_pool_lock:
+        if _db_pool_warmed:
+            return
+        _db_pool_warmed = True
+    for _ in range(max(0, DB_POOL_MIN_SIZE - 1)):
+        try:
+            conn = _open_connection()
+        except psycopg2.Error as e:
+            logger.warning(f"Failed to open DB connection: {e}")
+            return
+        with _db_pool_lock:
+            _db_idle.append(conn)
+
+def _is_connection_healthy(conn, info, now):
+    if conn.closed:
+        return False
+    if now - info["created"] > DB_POOL_MAX_LIFETIME:
+        return False
+    if now - info["last_used"] > DB_POOL_HEALTHCHECK_IDLE:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+def _checkout_connection():
+    # 期限切れ・切断済みのコネクションは捨てて、空きが無ければ新しく開く
+    while True:
+        with _db_pool_lock:
+            conn = _db_idle.pop() if _db_idle else None
+        if conn is None:
+            return _open_connection()
+        now = time.monotonic()
+        info = _db_conn_info.setdefault(id(conn), {"created": now, "last_used": now})
+        if _is_connection_healthy(conn, info, now):
+            return conn
+        _close_connection(conn)
+
+@contextmanager
+def db_connection():
+    """プールからコネクションを借りて、終わったら返却する。"""
+    _warm_db_pool()
+    wait_started = time.perf_counter()
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError("connection pool exhausted")
+    observe_metric("db_pool_wait_seconds", time.perf_counter() - wait_started)
+    conn = None
+    broken = False
+    try:
+        conn = _checkout_connection()
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if conn is not None:
+            if not broken and not conn.closed:
+                try:
+                    conn.rollback()  # 未コミットのトランザクションを残さない
+                except psycopg2.Error:
+                    broken = True
+            if broken or conn.closed:
+                _close_connection(conn)
+            else:
+                _db_conn_info[id(conn)]["last_used"] = time.monotonic()
+                with _db_pool_lock:
+                    _db_idle.append(conn)
+        _db_pool_slots.release()
+
+def close_db_pool():
+    with _db_pool_lock:
+        idle = list(_db_idle)
+        _db_idle.clear()
+    for conn in idle:
+        _close_connection(conn)
 
-# db接続
-def get_connection():
-    dsn = f"host={os.environ['DB_HOST']} " \
-          f"port=5432 " \
-          f"dbname={os.environ['DB_NAME']} " \
-          f"user={os.environ['DB_USER']} " \
-          f"password={os.environ['DB_PASS']}"
-    return psycopg2.connect(dsn)
+atexit.register(close_db_pool)
 
-@app.route("/")
 def hello_world():
     return "hello world!"
 
-@app.route("/callback", methods=['POST'])
+# WEBHOOK_ASYNC=true のときは、署名を確認して Redis のキューに積んだらすぐに200を返し、
+# LLM などの重い処理はワーカースレッドで行う
+WEBHOOK_ASYNC = os.environ.get("WEBHOOK_ASYNC", "false").lower() == "true"
+WEBHOOK_WORKER_THREADS = int(os.environ.get("WEBHOOK_WORKER_THREADS", 4))
+WEBHOOK_QUEUE_KEY = "line_webhook_queue"
+
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     # app.logger.info("Request body: " + body)
+    if WEBHOOK_ASYNC:
+        if not handler.parser.signature_validator.validate(body, signature):
+            abort(400)
+        job = json.dumps({"body": body, "signature": signature, "enqueued_at": time.time()})
+        queue_depth = redis_client.lpush(WEBHOOK_QUEUE_KEY, job)
+        observe_metric("webhook_queue_depth", queue_depth)
+        return 'OK'
     try:
-        handler.handle(body, signature)
+        handle_webhook(body, signature)
     except InvalidSignatureError:
         abort(400)
     return 'OK'
 
-# グローバル変数として sys_prompt を定義（または handle_line_message 内で初期化）
-current_prompt = ""
+def stripe_webhook():
+    if not STRIPE_WEBHOOK_SECRET:
+        abort(404)
+    payload = request.get_data()
+    signature = request.headers.get('Stripe-Signature', '')
+    try:
+        event = stripe.Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.SignatureVerificationError):
+        abort(400)
+    apply_subscription_event(event)
+    return 'OK'
 
 ###### LangChain ######
+# モデルの呼び出しごとにトークン数（キャッシュされた入力トークンを含む）をログに残す
+# 呼び出し元のチェーンに付けたタグから、どの段階の LLM 呼び出しかを見分ける
+LLM_STAGE_TAGS = ("router", "responder", "summary")
+
+class UsageLoggingCallback(BaseCallbackHandler):
+    def __init__(self):
+        self._started = {}  # run_id -> (段階, 開始時刻)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        stage = next((tag for tag in (tags or ()) if tag in LLM_STAGE_TAGS), "other")
+        self._started[run_id] = (stage, time.perf_counter())
+
+    def _finish(self, run_id):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            stage, started_at = started
+            observe_metric(f"stage_seconds:{stage}_llm", time.perf_counter() - started_at)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id)
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if not usage:
+                    continue
+                metadata = message.response_metadata or {}
+                model = metadata.get("model_name") or metadata.get("model") or "unknown"
+                details = usage.get("input_token_details") or {}
+                cached = details.get("cache_read", 0) or 0
+                observe_metric(f"llm_cached_input_tokens:{model}", cached)
+                increment_metric(f"llm_input_tokens:{model}", usage.get("input_tokens") or 0)
+                increment_metric(f"llm_output_tokens:{model}", usage.get("output_tokens") or 0)
+                logger.info(f"LLM usage: model={model} input_tokens={usage.get('input_tokens')} "
+                            f"cached_input_tokens={cached} cache_creation_tokens={details.get('cache_creation', 0)} "
+                            f"output_tokens={usage.get('output_tokens')}")
+
+usage_logging_callback = UsageLoggingCallback()
+
 def _per_request_config_modifier(config: Dict[str, Any], userId: str) -> Dict[str, Any]:
     config = config.copy()
 
@@ -109,6 +413,7 @@ def _per_request_config_modifier(config: Dict[str, Any], userId: str) -> Dict[st
 
     config["configurable"]["conversation_id"] = userId  # conversation_idとしてlineidを使用
     config["configurable"]["user_id"] = userId
+    config["callbacks"] = [usage_logging_callback]
 
     return config
 
@@ -134,32 +439,194 @@ db_config = {
     'database': os.environ['DB_NAME'],
 }
 
-# データベースからメッセージ履歴を取得する関数
-def get_session_history(user_id: str,
-                        conversation_id: str = None) -> BaseChatMessageHistory:
-    if conversation_id is None:
-        conversation_id = user_id
+# 1回のLINEイベントの処理中に使い回す履歴のキャッシュ（conversation_id -> メッセージのリスト）
+# RunnableWithMessageHistory はチェーンごとに get_session_history を呼ぶので、ここで1回の読み込みにまとめる
+HISTORY_LIMIT = int(os.environ.get("HISTORY_MAX_MESSAGES", 41))  # 読み込む件数の上限
+_request_history = contextvars.ContextVar("request_history", default=None)
 
-    with psycopg2.connect(**db_config, cursor_factory=RealDictCursor) as conn:
-        with conn.cursor() as cur:
+@contextmanager
+def request_history_scope():
+    token = _request_history.set({})
+    try:
+        yield
+    finally:
+        _request_history.reset(token)
+
+def _message_from_row(sender, message):
+    role = 'assistant' if sender == 'system' else 'user'
+    return {"role": role, "content": message}
+
+# データベースからメッセージ履歴を取得する関数
+def _load_history_messages(conversation_id):
+    log_writer.flush(conversation_id)  # まだ書き出していない発言も読めるようにする
+    with db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
             # cur.execute('SELECT sender, message FROM line_bot_logs WHERE Lineid = %s ORDER BY timestamp DESC, id DESC', 
             #             (conversation_id,))
-            # 直近41件のメッセージを取得するクエリに変更
-            cur.execute('SELECT sender, message FROM line_bot_logs WHERE Lineid = %s AND is_active = TRUE ORDER BY id DESC LIMIT 41', 
-                         (conversation_id,))
+            # 直近 HISTORY_LIMIT 件のメッセージを取得する
+            cur.execute('SELECT sender, message FROM line_bot_logs WHERE Lineid = %s AND is_active = TRUE ORDER BY id DESC LIMIT %s', 
+                         (conversation_id, HISTORY_LIMIT))
             rows = cur.fetchall()
 
             # メッセージを逆順から元の順序に戻す
             rows.reverse()
-            
-            chat_history = ChatMessageHistory()
-            for row in rows:
-                role = 'assistant' if row['sender'] == 'system' else 'user'
-                chat_history.add_message({"role": role, "content": row['message']})
-            
-            # # デバッグ用: 追加された履歴を出力
-            # print("Chat history being returned:", chat_history.messages)
-            return chat_history
+            return [_message_from_row(row['sender'], row['message']) for row in rows]
+
+# 履歴は件数ではなくトークン数の予算で切る。ルーターは直近の文脈が分かれば十分なので小さくする
+HISTORY_TOKEN_BUDGET_ROUTER = int(os.environ.get("HISTORY_TOKEN_BUDGET_ROUTER", 1000))
+HISTORY_TOKEN_BUDGET_RESPONDER = int(os.environ.get("HISTORY_TOKEN_BUDGET_RESPONDER", 6000))
+
+def estimate_tokens(text):
+    # トークナイザーは使わずに、日本語は1文字1トークン、ASCIIは4文字で1トークンとして見積もる
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+def _fit_to_token_budget(messages, token_budget):
+    # 新しいものから順に予算いっぱいまで詰める。最新の1件は予算を超えても必ず入れる
+    selected = []
+    used = 0
+    for message in reversed(messages):
+        cost = estimate_tokens(message["content"] or "")
+        if selected and used + cost > token_budget:
+            break
+        selected.append(message)
+        used += cost
+    selected.reverse()
+    return selected
+
+# 履歴の窓から外れた古い対話の要約（conversation_summaries テーブル、Redis にもキャッシュする）
+def get_conversation_summary(conversation_id):
+    key = f"conversation_summary:{conversation_id}"
+    try:
+        cached = redis_client.get(key)
+        if cached is not None:
+            return cached.decode('utf-8')
+    except redis.RedisError as e:
+        logger.warning(f"Failed to read summary cache: {e}")
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT summary FROM conversation_summaries WHERE lineId = %s', (conversation_id,))
+            row = cur.fetchone()
+    summary = row[0] if row and row[0] else ""
+    try:
+        # 要約が無いことも覚えておき、毎回DBを読まないようにする
+        redis_client.set(key, summary, ex=HISTORY_CACHE_TTL)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to fill summary cache: {e}")
+    return summary
+
+def _summary_message(summary):
+    return {"role": "system", "content": f"これまでの対話の要約:\n{summary}"}
+
+@timed("get_session_history")
+def get_session_history(user_id: str,
+                        conversation_id: str = None,
+                        token_budget: int = None,
+                        include_summary: bool = False) -> BaseChatMessageHistory:
+    if conversation_id is None:
+        conversation_id = user_id
+
+    cache = _request_history.get()
+    if cache is None:
+        messages = RedisChatMessageHistory(conversation_id).messages
+    else:
+        if conversation_id not in cache:
+            cache[conversation_id] = RedisChatMessageHistory(conversation_id).messages
+        messages = cache[conversation_id]
+    if token_budget is not None:
+        messages = _fit_to_token_budget(messages, token_budget)
+
+    if include_summary:
+        if cache is None:
+            summary = get_conversation_summary(conversation_id)
+        else:
+            summary_key = ("summary", conversation_id)
+            if summary_key not in cache:
+                cache[summary_key] = get_conversation_summary(conversation_id)
+            summary = cache[summary_key]
+        if summary:
+            messages = [_summary_message(summary)] + messages
+
+    # チェーンが履歴に書き込んでもキャッシュが汚れないように、毎回新しい ChatMessageHistory に詰め直す
+    chat_history = InMemoryChatMessageHistory()
+    for message in messages:
+        chat_history.add_message(message)
+    
+    # # デバッグ用: 追加された履歴を出力
+    # print("Chat history being returned:", chat_history.messages)
+    return chat_history
+
+def _history_factory(token_budget, include_summary=False):
+    def factory(user_id: str, conversation_id: str = None) -> BaseChatMessageHistory:
+        return get_session_history(user_id, conversation_id, token_budget=token_budget, include_summary=include_summary)
+    return factory
+
+# Redis に直近 HISTORY_LIMIT 件の履歴を保持する（PostgreSQL は永続ログとして残し、キャッシュミス時だけ読む）
+HISTORY_CACHE_TTL = int(os.environ.get("HISTORY_CACHE_TTL", 86400))
+
+# キーがあるときだけ追記する。キャッシュが無い状態で1件だけ積むと、窓の途中から始まる履歴になってしまうため
+# KEYS[2] は要約にまだ畳み込んでいない発言の数。キーが無い間は数が分からないので足さない（要約の処理が数え直す）
+_append_history_script = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('INCR', KEYS[2])
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+end
+return 0
+""")
+
+def _summary_pending_key(conversation_id):
+    return f"summary_pending:{conversation_id}"
+
+class RedisChatMessageHistory(BaseChatMessageHistory):
+    """LINEユーザーごとの直近の履歴を、長さ上限付きの Redis リストで保持する。"""
+
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.key = f"chat_history:{conversation_id}"
+
+    @property
+    def messages(self):
+        try:
+            items = redis_client.lrange(self.key, 0, -1)
+        except redis.RedisError as e:
+            logger.warning(f"Failed to read history cache: {e}")
+            return _load_history_messages(self.conversation_id)
+        if items:
+            return [json.loads(item) for item in items]
+
+        messages = _load_history_messages(self.conversation_id)
+        if messages:
+            try:
+                with redis_client.pipeline() as pipe:
+                    pipe.delete(self.key)
+                    pipe.rpush(self.key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+                    pipe.expire(self.key, HISTORY_CACHE_TTL)
+                    pipe.execute()
+            except redis.RedisError as e:
+                logger.warning(f"Failed to fill history cache: {e}")
+        return messages
+
+    def add_message(self, message):
+        if isinstance(message, BaseMessage):
+            message = {"role": "assistant" if message.type == "ai" else "user", "content": message.content}
+        try:
+            _append_history_script(keys=[self.key, _summary_pending_key(self.conversation_id)], args=[json.dumps(message, ensure_ascii=False), HISTORY_LIMIT, HISTORY_CACHE_TTL])
+        except redis.RedisError as e:
+            # 追記に失敗したら古い窓を返さないようにキャッシュごと捨てる
+            logger.warning(f"Failed to append history cache: {e}")
+            self.clear()
+
+    def clear(self):
+        try:
+            redis_client.delete(self.key)
+        except redis.RedisError as e:
+            logger.warning(f"Failed to clear history cache: {e}")
 
 # def get_session_history(user_id: str,
 #                         conversation_id: str = None) -> BaseChatMessageHistory:
@@ -177,13 +644,19 @@ def get_session_history(user_id: str,
 #                 chat_history.add_message(row['message'])  # roleは不要ならば削除
 #             return chat_history
 
+# モデルのクライアントとチェーンは、最初に使うときに作ってプロセス内で使い回す
+# （各プロバイダの SDK の import とクライアントの生成は重いので、ワーカーの起動時には行わない）
+
 # ルートモデル選択
-model_root = ChatGoogleGenerativeAI(
-    temperature=0,
-    model="gemini-1.5-flash",
-    top_p=0.95,
-    top_k=64,
-)
+@lru_cache(maxsize=None)
+def get_model_root():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        temperature=0,
+        model="gemini-1.5-flash",
+        top_p=0.95,
+        top_k=64,
+    )
 # model_root = ChatOpenAI(temperature=0, model="gpt-4o-mini")
 
 # 応答モデル選択
@@ -191,14 +664,297 @@ model_root = ChatGoogleGenerativeAI(
 model_name = "gpt-4o-2024-08-06"
 # model_name="claude-3-5-sonnet-20240620"
 
-if model_name.startswith("gemini"):
-    model_response = ChatGoogleGenerativeAI(temperature=1, model=model_name)
-elif model_name.startswith("gpt"):
-    model_response = ChatOpenAI(temperature=1, model=model_name)
-elif model_name.startswith("claude"):
-    model_response = ChatAnthropic(temperature=1, model=model_name)
-else:
-    raise ValueError("Unknown model name")
+# Anthropic はプロンプトキャッシュを明示的に指定する必要があるので、
+# 先頭のシステムプロンプトと、直前までの履歴の末尾に cache_control を付ける
+def _with_cache_control(message):
+    content = message.content if isinstance(message.content, list) else [{"type": "text", "text": message.content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    return message.model_copy(update={"content": content})
+
+def add_anthropic_cache_control(prompt_value):
+    messages = prompt_value.to_messages()
+    # 先頭に続くシステムメッセージ（プロンプト本体と要約）は1つにまとめる。キャッシュの区切りはプロンプト本体の直後
+    system_blocks = []
+    while messages and isinstance(messages[0], SystemMessage):
+        system_blocks.append({"type": "text", "text": messages.pop(0).content})
+    if system_blocks:
+        system_blocks[0]["cache_control"] = {"type": "ephemeral"}
+        messages.insert(0, SystemMessage(content=system_blocks))
+    # 最後のメッセージ（今回の入力）の1つ前までを、次のターンでも使い回せる部分としてキャッシュする
+    if len(messages) >= 3:
+        messages[-2] = _with_cache_control(messages[-2])
+    return messages
+
+# Gemini も先頭以外のシステムメッセージを受け付けないので、先頭に続くもの（プロンプト本体と要約）を1つにまとめる
+def merge_leading_system_messages(prompt_value):
+    messages = prompt_value.to_messages()
+    system_texts = []
+    while messages and isinstance(messages[0], SystemMessage):
+        system_texts.append(messages.pop(0).content)
+    if system_texts:
+        messages.insert(0, SystemMessage(content="\n\n".join(system_texts)))
+    return messages
+
+# 応答モデルのフェイルオーバー
+# model_name のプロバイダを優先し、失敗したら RESPONSE_FALLBACK_MODELS の順に切り替える
+RESPONSE_FALLBACK_MODELS = [name for name in os.environ.get(
+    "RESPONSE_FALLBACK_MODELS", "gpt-4o-2024-08-06,claude-3-5-sonnet-20240620,gemini-1.5-flash").split(",") if name]
+RESPONSE_MODEL_TIMEOUT = float(os.environ.get("RESPONSE_MODEL_TIMEOUT", 60))
+RESPONSE_HEDGING = os.environ.get("RESPONSE_HEDGING", "false").lower() == "true"
+RESPONSE_HEDGE_DEFAULT_DELAY = float(os.environ.get("RESPONSE_HEDGE_DEFAULT_DELAY", 10))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 3))
+CIRCUIT_RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", 60))
+
+class CircuitBreaker:
+    """連続して失敗したプロバイダを一定時間使わないようにする。時間が過ぎたら再び試して、成功すれば元に戻す"""
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            return self.opened_at is None or time.monotonic() - self.opened_at >= self.reset_seconds
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # 試しに使った直後にまた失敗したら、すぐに遮断し直す
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+class ResponseModelRouter(Runnable):
+    """応答モデルを複数のプロバイダに振り分ける Runnable
+
+    providers は (名前, チャットモデル) の優先順のリスト。テストではローカルの Fake チャットモデルを渡せる。
+    hedging を有効にすると、優先プロバイダの p95 を過ぎても返ってこない場合に次のプロバイダにも投げて、先に返った方を使う。
+    ストリーミングでは最初のチャンクが届く前の失敗だけを切り替える（途中まで送った応答は混ぜられないため）。
+    """
+
+    def __init__(self, providers, hedging=RESPONSE_HEDGING, hedge_default_delay=RESPONSE_HEDGE_DEFAULT_DELAY, executor=None):
+        self.providers = [(name, model, CircuitBreaker()) for name, model in providers]
+        self.hedging = hedging
+        self.hedge_default_delay = hedge_default_delay
+        self._executor = executor or ThreadPoolExecutor(max_workers=int(os.environ.get("HEDGE_THREADS", 8)))
+
+    def _candidates(self):
+        candidates = [provider for provider in self.providers if provider[2].allow()]
+        # すべて遮断中なら、何もせずに失敗させるより優先プロバイダを試す
+        return candidates or self.providers[:1]
+
+    def _hedge_delay(self, name):
+        return get_metric_percentile(f"response_model_seconds:{name}", 0.95) or self.hedge_default_delay
+
+    @staticmethod
+    def _mark(name, message):
+        # 実際に応答したプロバイダを結果に残す（ログの model 列に使う）
+        message.response_metadata["response_model"] = name
+        return message
+
+    def _record(self, name, breaker, started, error=None):
+        if error is None:
+            breaker.record_success()
+            observe_metric(f"response_model_seconds:{name}", time.perf_counter() - started)
+        else:
+            breaker.record_failure()
+            increment_metric(f"response_model_failures:{name}")
+            logger.warning(f"Response model {name} failed: {error!r}")
+
+    def _call(self, provider, input, config):
+        name, model, breaker = provider
+        started = time.perf_counter()
+        try:
+            result = model.invoke(input, config)
+        except Exception as e:
+            self._record(name, breaker, started, e)
+            raise
+        self._record(name, breaker, started)
+        return self._mark(name, result)
+
+    async def _acall(self, provider, input, config):
+        name, model, breaker = provider
+        started = time.perf_counter()
+        try:
+            result = await model.ainvoke(input, config)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record(name, breaker, started, e)
+            raise
+        self._record(name, breaker, started)
+        return self._mark(name, result)
+
+    def invoke(self, input, config=None, **kwargs):
+        candidates = self._candidates()
+        if not self.hedging:
+            for provider in candidates:
+                try:
+                    return self._call(provider, input, config)
+                except Exception as e:
+                    error = e
+            raise error
+
+        pending = {}
+        error = None
+        def launch():
+            provider = candidates.pop(0)
+            # トレースの親子関係を保つため、呼び出し元のコンテキストのまま別スレッドで実行する
+            future = self._executor.submit(contextvars.copy_context().run, self._call, provider, input, config)
+            pending[future] = provider[0]
+            return provider[0]
+
+        delay = self._hedge_delay(launch())
+        while pending:
+            done, _ = wait(pending, timeout=delay if candidates else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # 締め切りまでに返ってこなかったので、次のプロバイダにも投げる。遅い方の結果は捨てる
+                increment_metric("response_model_hedged")
+                delay = self._hedge_delay(launch())
+                continue
+            for future in done:
+                pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+            if candidates and not pending:
+                delay = self._hedge_delay(launch())
+        raise error
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        candidates = self._candidates()
+        if not self.hedging:
+            for provider in candidates:
+                try:
+                    return await self._acall(provider, input, config)
+                except Exception as e:
+                    error = e
+            raise error
+
+        pending = {}
+        error = None
+        def launch():
+            provider = candidates.pop(0)
+            pending[asyncio.ensure_future(self._acall(provider, input, config))] = provider[0]
+            return provider[0]
+
+        delay = self._hedge_delay(launch())
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=delay if candidates else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    increment_metric("response_model_hedged")
+                    delay = self._hedge_delay(launch())
+                    continue
+                for task in done:
+                    pending.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        error = e
+                if candidates and not pending:
+                    delay = self._hedge_delay(launch())
+            raise error
+        finally:
+            # 非同期版では負けた方のリクエストを取り消せる
+            for task in pending:
+                task.cancel()
+
+    def stream(self, input, config=None, **kwargs):
+        error = None
+        for name, model, breaker in self._candidates():
+            started = time.perf_counter()
+            stream = model.stream(input, config)
+            started_output = False
+            completed = False
+            try:
+                for chunk in stream:
+                    if not started_output:
+                        # チャンクを連結すると response_metadata の文字列も連結されるので、最初のチャンクにだけ付ける
+                        self._mark(name, chunk)
+                    started_output = True
+                    yield chunk
+                completed = True
+            except GeneratorExit:
+                # </response> で呼び出し側が打ち切るのが普通の終わり方なので、これも成功として数える
+                completed = True
+                raise
+            except Exception as e:
+                self._record(name, breaker, started, e)
+                if started_output:
+                    raise
+                error = e
+                continue
+            finally:
+                stream.close()
+                if completed:
+                    self._record(name, breaker, started)
+            return
+        raise error
+
+    async def astream(self, input, config=None, **kwargs):
+        error = None
+        for name, model, breaker in self._candidates():
+            started = time.perf_counter()
+            stream = model.astream(input, config)
+            started_output = False
+            completed = False
+            try:
+                async for chunk in stream:
+                    if not started_output:
+                        # チャンクを連結すると response_metadata の文字列も連結されるので、最初のチャンクにだけ付ける
+                        self._mark(name, chunk)
+                    started_output = True
+                    yield chunk
+                completed = True
+            except GeneratorExit:
+                # stream と同じく、呼び出し側が閉じた場合も成功として数える
+                completed = True
+                raise
+            except Exception as e:
+                self._record(name, breaker, started, e)
+                if started_output:
+                    raise
+                error = e
+                continue
+            finally:
+                await stream.aclose()
+                if completed:
+                    self._record(name, breaker, started)
+            return
+        raise error
+
+def build_response_model(name):
+    # 切り替えを速くするため、クライアント側のリトライは1回に抑えてタイムアウトを指定する
+    if name.startswith("gemini"):
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return RunnableLambda(merge_leading_system_messages) | ChatGoogleGenerativeAI(
+            temperature=1, model=name, timeout=RESPONSE_MODEL_TIMEOUT, max_retries=1)
+    elif name.startswith("gpt"):
+        from langchain_openai import ChatOpenAI
+        # OpenAI は先頭が同じプロンプトを自動でキャッシュする。stream_usage はストリーミング時にも使用量を受け取るため
+        return ChatOpenAI(temperature=1, model=name, stream_usage=True, timeout=RESPONSE_MODEL_TIMEOUT, max_retries=1)
+    elif name.startswith("claude"):
+        from langchain_anthropic import ChatAnthropic
+        return RunnableLambda(add_anthropic_cache_control) | ChatAnthropic(
+            temperature=1, model=name, default_request_timeout=RESPONSE_MODEL_TIMEOUT, max_retries=1)
+    else:
+        raise ValueError("Unknown model name")
+
+response_model_names = [model_name] + [name for name in RESPONSE_FALLBACK_MODELS if name != model_name]
+
+@lru_cache(maxsize=None)
+def get_model_response():
+    return ResponseModelRouter([(name, build_response_model(name)) for name in response_model_names]).with_config(tags=["responder"])
 
 root_prompt = f"""
 ユーザの入力: {{input}}
@@ -215,42 +971,44 @@ root_prompt = f"""
 #          | model_root
 #          | StrOutputParser())
 
-chain = (
-    ChatPromptTemplate.from_messages([
-        (
-            "system",
-            root_prompt,
-        ),
-        MessagesPlaceholder(variable_name="history"),
-        # ("human", "{input}"),
-    ])
-    | model_root
-    | StrOutputParser())
-
-chain_memory = RunnableWithMessageHistory(
-    chain,
-    get_session_history,
-    input_messages_key="input",
-    history_messages_key="history",
-    history_factory_config=[
-        ConfigurableFieldSpec(
-            id="user_id",
-            annotation=str,
-            name="User ID",
-            description="Unique identifier for the user.",
-            default="",
-            is_shared=True,
-        ),
-        ConfigurableFieldSpec(
-            id="conversation_id",
-            annotation=str,
-            name="Conversation ID",
-            description="Unique identifier for the conversation.",
-            default="",
-            is_shared=True,
-        ),
-    ],
-)
+@lru_cache(maxsize=None)
+def get_chain_memory():
+    chain = (
+        ChatPromptTemplate.from_messages([
+            (
+                "system",
+                root_prompt,
+            ),
+            MessagesPlaceholder(variable_name="history"),
+            # ("human", "{input}"),
+        ])
+        | get_model_root().with_config(tags=["router"])
+        | StrOutputParser())
+
+    return RunnableWithMessageHistory(
+        chain,
+        _history_factory(HISTORY_TOKEN_BUDGET_ROUTER),
+        input_messages_key="input",
+        history_messages_key="history",
+        history_factory_config=[
+            ConfigurableFieldSpec(
+                id="user_id",
+                annotation=str,
+                name="User ID",
+                description="Unique identifier for the user.",
+                default="",
+                is_shared=True,
+            ),
+            ConfigurableFieldSpec(
+                id="conversation_id",
+                annotation=str,
+                name="Conversation ID",
+                description="Unique identifier for the conversation.",
+                default="",
+                is_shared=True,
+            ),
+        ],
+    )
 
 # 分岐先1：聞き返し
 reflection_prompt = f"""
@@ -334,46 +1092,51 @@ REBTのフロー・ステップ
 
 
 対話を通して応答作成の手順を順守し、1つのフローステップを3回以上続けてください。
+"""
 
-ユーザ入力: {{input}}
+# ユーザの入力は毎回変わるので、システムプロンプトには含めずに履歴の後ろに置く
+# （システムプロンプトと過去の履歴が毎回同じ先頭部分になり、プロンプトキャッシュが効く）
+reflection_input_prompt = """ユーザ入力: {input}
 Response:
 """
 
-reflection_chain = (
-    ChatPromptTemplate.from_messages([
-        (
-            "system",
-            reflection_prompt,
-        ),
-        MessagesPlaceholder(variable_name="history"),
-        # ("human", "{input}"),
-    ])
-    | model_response)
-
-reflection_chain_memory = RunnableWithMessageHistory(
-    reflection_chain,
-    get_session_history,
-    input_messages_key="input",
-    history_messages_key="history",
-    history_factory_config=[
-        ConfigurableFieldSpec(
-            id="user_id",
-            annotation=str,
-            name="User ID",
-            description="Unique identifier for the user.",
-            default="",
-            is_shared=True,
-        ),
-        ConfigurableFieldSpec(
-            id="conversation_id",
-            annotation=str,
-            name="Conversation ID",
-            description="Unique identifier for the conversation.",
-            default="",
-            is_shared=True,
-        ),
-    ],
-)
+@lru_cache(maxsize=None)
+def get_reflection_chain_memory():
+    reflection_chain = (
+        ChatPromptTemplate.from_messages([
+            (
+                "system",
+                reflection_prompt,
+            ),
+            MessagesPlaceholder(variable_name="history"),
+            ("human", reflection_input_prompt),
+        ])
+        | get_model_response())
+
+    return RunnableWithMessageHistory(
+        reflection_chain,
+        _history_factory(HISTORY_TOKEN_BUDGET_RESPONDER, include_summary=True),
+        input_messages_key="input",
+        history_messages_key="history",
+        history_factory_config=[
+            ConfigurableFieldSpec(
+                id="user_id",
+                annotation=str,
+                name="User ID",
+                description="Unique identifier for the user.",
+                default="",
+                is_shared=True,
+            ),
+            ConfigurableFieldSpec(
+                id="conversation_id",
+                annotation=str,
+                name="Conversation ID",
+                description="Unique identifier for the conversation.",
+                default="",
+                is_shared=True,
+            ),
+        ],
+    )
 
 # 分岐先2: 質問への回答
 question_prompt = f"""
@@ -413,71 +1176,464 @@ question_prompt = f"""
 
 # 回答の出力
 回答は<response>タブ内に出力してください。
+"""
 
-ユーザの質問: {{input}}
+question_input_prompt = """ユーザの質問: {input}
 Response:
 """
 
-question_chain = (ChatPromptTemplate.from_messages([
-    (
-        "system",
-        question_prompt,
-    ),
-    MessagesPlaceholder(variable_name="history"),
-    # ("human", "{input}"),
-])
-                  | model_response)
-
-# question_chain_memory = question_chain
-question_chain_memory = RunnableWithMessageHistory(
-    question_chain,
-    get_session_history,
-    input_messages_key="input",
-    history_messages_key="history",
-    history_factory_config=[
-        ConfigurableFieldSpec(
-            id="user_id",
-            annotation=str,
-            name="User ID",
-            description="Unique identifier for the user.",
-            default="",
-            is_shared=True,
-        ),
-        ConfigurableFieldSpec(
-            id="conversation_id",
-            annotation=str,
-            name="Conversation ID",
-            description="Unique identifier for the conversation.",
-            default="",
-            is_shared=True,
+@lru_cache(maxsize=None)
+def get_question_chain_memory():
+    question_chain = (ChatPromptTemplate.from_messages([
+        (
+            "system",
+            question_prompt,
         ),
-    ],
-)
+        MessagesPlaceholder(variable_name="history"),
+        ("human", question_input_prompt),
+    ])
+                      | get_model_response())
+
+    # question_chain_memory = question_chain
+    return RunnableWithMessageHistory(
+        question_chain,
+        _history_factory(HISTORY_TOKEN_BUDGET_RESPONDER, include_summary=True),
+        input_messages_key="input",
+        history_messages_key="history",
+        history_factory_config=[
+            ConfigurableFieldSpec(
+                id="user_id",
+                annotation=str,
+                name="User ID",
+                description="Unique identifier for the user.",
+                default="",
+                is_shared=True,
+            ),
+            ConfigurableFieldSpec(
+                id="conversation_id",
+                annotation=str,
+                name="Conversation ID",
+                description="Unique identifier for the conversation.",
+                default="",
+                is_shared=True,
+            ),
+        ],
+    )
 
 # 統合
 # ルート関数
+# 選ばれた分岐と、その分岐のシステムプロンプト、実際に応答したモデルも応答と一緒に返す
+# （リクエストごとに持ち回るため、グローバル変数は使わない）
+def response_model_of(message):
+    return message.response_metadata.get("response_model", model_name)
+
+def _routed_branch(route_name, sys_prompt, chain_with_memory):
+    return chain_with_memory | RunnableParallel(
+        route=RunnableLambda(lambda x: route_name),
+        sys_prompt=RunnableLambda(lambda x: sys_prompt),
+        response=StrOutputParser(),
+        model=RunnableLambda(response_model_of),
+    )
+
+@lru_cache(maxsize=None)
+def get_question_branch():
+    return _routed_branch("question", question_prompt, get_question_chain_memory())
+
+@lru_cache(maxsize=None)
+def get_reflection_branch():
+    return _routed_branch("other", reflection_prompt, get_reflection_chain_memory())
+
 def route(info):
-    global current_prompt
     # print("root_decision: ", info["topic"].lower())
     if "question" in info["topic"].lower():
-        current_prompt = question_prompt.format(input="{input}")
-        return question_chain_memory
+        return get_question_branch()
     # elif "other" in info["topic"].lower():
     #     return reflection_chain
     else:
-        current_prompt = reflection_prompt.format(input="{input}")
-        return reflection_chain_memory
+        return get_reflection_branch()
 
 
 # RunnableLambdaを使った結合
-full_chain = {
-    # "topic": chain,
-    "topic": chain_memory,
-    "input": lambda x: x["input"]
-} | RunnableLambda(route) | StrOutputParser()
+# 出力は {"route": ..., "sys_prompt": ..., "response": ...}
+@lru_cache(maxsize=None)
+def get_full_chain():
+    return {
+        # "topic": chain,
+        "topic": get_chain_memory(),
+        "input": lambda x: x["input"]
+    } | RunnableLambda(route)
 
 # store = {}
 
+# 窓から外れた対話を要約に畳み込む（応答を返した後にバックグラウンドで実行する）
+SUMMARY_MIN_MESSAGES = int(os.environ.get("SUMMARY_MIN_MESSAGES", 10))  # 窓から外れた発言がこの件数たまったら要約する
+SUMMARY_MAX_MESSAGES = int(os.environ.get("SUMMARY_MAX_MESSAGES", 100))  # 1回に畳み込む最大件数
+_background_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("BACKGROUND_THREADS", 2)))
+
+summary_prompt = """
+あなたはREBT（論理情動行動療法）のカウンセリングの記録係です。これまでの要約と、その後に続く対話をもとに、要約を更新してください。
+ユーザの困りごと、どうなりたいか、問題となっている感情や場面、特定されたイラショナルな信念、REBTのフローのどのステップまで進んだかを中心に、
+後からカウンセラーが文脈を把握できるように簡潔にまとめてください。要約の本文のみを出力してください。
+
+これまでの要約:
+{summary}
+
+続きの対話:
+{transcript}
+"""
+
+@lru_cache(maxsize=None)
+def get_summary_chain():
+    return PromptTemplate.from_template(summary_prompt) | get_model_root().with_config(tags=["summary"]) | StrOutputParser()
+
+# 要約に畳み込むのは、応答チェーンに渡す履歴（HISTORY_TOKEN_BUDGET_RESPONDER で切った窓）から外れた発言
+# 件数の上限（HISTORY_LIMIT）で切ると、トークンの窓からは外れたが要約にも入っていない発言が出てしまう
+def _responder_window(messages):
+    return _fit_to_token_budget(messages, HISTORY_TOKEN_BUDGET_RESPONDER)
+
+def update_conversation_summary(userId):
+    # 毎ターン呼ばれるので、まず Redis だけを見る。窓から外れた発言が SUMMARY_MIN_MESSAGES 件たまるまでは
+    # バッファを書き出させず（LOG_BATCH_SIZE でまとめて書けるように）、ロックも DB も使わない
+    pending_key = _summary_pending_key(userId)
+    try:
+        pending = redis_client.get(pending_key)
+        if pending is not None:
+            pending = int(pending)
+            if pending <= SUMMARY_MIN_MESSAGES:
+                return
+            if pending - len(_responder_window(RedisChatMessageHistory(userId).messages)) < SUMMARY_MIN_MESSAGES:
+                return
+    except redis.RedisError as e:
+        logger.warning(f"Failed to read summary counter: {e}")
+        return
+
+    lock_key = f"summary_lock:{userId}"
+    if not redis_client.set(lock_key, 1, nx=True, ex=300):
+        return
+    try:
+        log_writer.flush(userId)
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT summary, last_summarized_id FROM conversation_summaries WHERE lineId = %s', (userId,))
+                row = cur.fetchone()
+                summary, last_summarized_id = row if row else ("", 0)
+                # 数が分からなかった場合や、ずれていた場合に備えて数え直す
+                cur.execute('SELECT COUNT(*) FROM line_bot_logs WHERE lineId = %s AND is_active = TRUE AND id > %s',
+                            (userId, last_summarized_id or 0))
+                pending = cur.fetchone()[0]
+                redis_client.set(pending_key, pending, ex=HISTORY_CACHE_TTL)
+                # get_session_history と同じ読み方・同じ予算で窓を決め、その一番古い発言より前を畳み込む
+                cur.execute('SELECT id, sender, message FROM line_bot_logs WHERE lineId = %s AND is_active = TRUE ORDER BY id DESC LIMIT %s',
+                            (userId, HISTORY_LIMIT))
+                recent = [dict(_message_from_row(sender, message), id=log_id) for log_id, sender, message in reversed(cur.fetchall())]
+                window = _responder_window(recent)
+                if not window or pending - len(window) < SUMMARY_MIN_MESSAGES:
+                    return
+                cur.execute("""
+                    SELECT id, sender, message FROM line_bot_logs
+                    WHERE lineId = %s AND is_active = TRUE AND id > %s AND id < %s
+                    ORDER BY id LIMIT %s
+                """, (userId, last_summarized_id or 0, window[0]["id"], SUMMARY_MAX_MESSAGES))
+                rows = cur.fetchall()
+        if len(rows) < SUMMARY_MIN_MESSAGES:
+            return
+
+        transcript = "\n".join(f"{'AI' if sender == 'system' else 'ユーザ'}: {message}" for _, sender, message in rows)
+        new_summary = get_summary_chain().invoke({"summary": summary or "（なし）", "transcript": transcript},
+                                                 config={"callbacks": [usage_logging_callback]}).strip()
+
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO conversation_summaries (lineId, summary, last_summarized_id, updated_at)
+                    VALUES (%s, %s, %s, NOW())
+                    ON CONFLICT (lineId) DO UPDATE
+                    SET summary = EXCLUDED.summary, last_summarized_id = EXCLUDED.last_summarized_id, updated_at = EXCLUDED.updated_at
+                """, (userId, new_summary, rows[-1][0]))
+            conn.commit()
+        with redis_client.pipeline() as pipe:
+            pipe.set(f"conversation_summary:{userId}", new_summary, ex=HISTORY_CACHE_TTL)
+            pipe.decr(pending_key, len(rows))
+            pipe.execute()
+        logger.info(f"Folded {len(rows)} messages into the conversation summary for {userId}")
+    except Exception as e:
+        logger.error(f"Failed to update conversation summary: {e}")
+    finally:
+        redis_client.delete(lock_key)
+
+def schedule_summary_update(userId):
+    _background_executor.submit(update_conversation_summary, userId)
+
+# ルーティングの方式
+# llm: 従来通り Gemini のルーターの結果を待ってから応答チェーンを呼ぶ
+# heuristic: はっきり判断できる入力はローカルのルールで振り分け、迷うときだけ LLM のルーターを使う
+# speculative: ルーターと並行して聞き返し（reflection）の応答を先に作り始め、"question" だったら捨てる
+ROUTER_MODE = os.environ.get("ROUTER_MODE", "llm")
+_speculation_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SPECULATION_THREADS", 8)))
+
+# 話題の単語（REBT やアプリなど）だけでは質問と決めない。「アプリを開くのが辛い」のような相談もあるため、
+# 質問の形をしているものだけをここで拾い、それ以外は LLM のルーターに任せる
+_QUESTION_PATTERN = re.compile(r"[?？]\s*$|教えて|とは(何|なに)|って(何|なに)(ですか|でしょうか)?[。\s]*$|どういう意味(ですか|でしょうか)?[。\s]*$")
+_ANSWER_PATTERN = re.compile(r"^(はい|いいえ|うん|ええ|そう|そうです|そうですね|違います|ちがいます|わかりました|ありがとう|ありがとうございます)[。！!、\s]*$")
+
+def classify_locally(text):
+    """明らかな場合だけ "question" か "other" を返し、判断がつかなければ None を返す。"""
+    text = text.strip()
+    if _ANSWER_PATTERN.match(text):
+        return "other"
+    if _QUESTION_PATTERN.search(text):
+        return "question"
+    return None
+
+# STREAM_RESPONSES=true のときは応答をトークン単位で受け取り、</response> が来た時点で生成を打ち切る
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "false").lower() == "true"
+
+class ResponseTagParser:
+    """ストリームで届く文字列を溜めながら、<response>...</response> が閉じたかを調べる。"""
+
+    OPEN_TAG = "<response>"
+    CLOSE_TAG = "</response>"
+
+    def __init__(self):
+        self.text = ""
+        self._open_at = -1
+
+    def feed(self, chunk):
+        # 直前のチャンクとの境目でタグが分かれていても見つけられるように、少し前から探す
+        search_from = max(0, len(self.text) - len(self.CLOSE_TAG))
+        self.text += chunk
+        if self._open_at < 0:
+            self._open_at = self.text.find(self.OPEN_TAG, search_from)
+            if self._open_at < 0:
+                return False
+            search_from = self._open_at + len(self.OPEN_TAG)
+        return self.text.find(self.CLOSE_TAG, max(search_from, self._open_at)) >= 0
+
+def _branch_for(topic):
+    if "question" in topic.lower():
+        return "question", question_prompt, get_question_chain_memory()
+    return "other", reflection_prompt, get_reflection_chain_memory()
+
+def _record_stream(route_name, started, chunks, early_stop):
+    time_to_reply = time.perf_counter() - started
+    observe_metric("response_time_to_reply_seconds", time_to_reply)
+    observe_metric("response_stream_chunks", chunks)
+    if early_stop:
+        increment_metric("response_stream_early_stop")
+    logger.info(f"Streamed response: route={route_name} time_to_reply={time_to_reply:.2f}s chunks={chunks} early_stop={early_stop}")
+
+def _chunk_text(chunk):
+    # Anthropic などはテキストを部品のリストで返すことがあるので、テキストの部品だけをつなぐ
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+
+def _run_branch(topic, input, config):
+    if not STREAM_RESPONSES:
+        return route({"topic": topic}).invoke(input, config)
+
+    route_name, sys_prompt, chain_with_memory = _branch_for(topic)
+    parser = ResponseTagParser()
+    started = time.perf_counter()
+    chunks = 0
+    early_stop = False
+    response_model = model_name
+    stream = chain_with_memory.stream(input, config)
+    try:
+        for chunk in stream:
+            chunks += 1
+            if chunks == 1:
+                response_model = response_model_of(chunk)
+            if parser.feed(_chunk_text(chunk)):
+                early_stop = True
+                break
+    finally:
+        stream.close()  # 閉じるとモデルへのストリーミング接続も切れて、残りの生成が止まる
+    _record_stream(route_name, started, chunks, early_stop)
+    return {"route": route_name, "sys_prompt": sys_prompt, "response": parser.text, "model": response_model}
+
+async def _arun_branch(topic, input, config):
+    if not STREAM_RESPONSES:
+        return await route({"topic": topic}).ainvoke(input, config)
+
+    route_name, sys_prompt, chain_with_memory = _branch_for(topic)
+    parser = ResponseTagParser()
+    started = time.perf_counter()
+    chunks = 0
+    early_stop = False
+    response_model = model_name
+    stream = chain_with_memory.astream(input, config)
+    try:
+        async for chunk in stream:
+            chunks += 1
+            if chunks == 1:
+                response_model = response_model_of(chunk)
+            if parser.feed(_chunk_text(chunk)):
+                early_stop = True
+                break
+    finally:
+        await stream.aclose()
+    _record_stream(route_name, started, chunks, early_stop)
+    return {"route": route_name, "sys_prompt": sys_prompt, "response": parser.text, "model": response_model}
+
+# よくある質問への回答キャッシュ（QUESTION_CACHE_ENABLED=true のときだけ、質問への回答の分岐に使う）
+# 正規化した文面が同じなら完全一致、文字バイグラムの Jaccard 係数がしきい値以上なら類似として同じ回答を返す
+QUESTION_CACHE_ENABLED = os.environ.get("QUESTION_CACHE_ENABLED", "false").lower() == "true"
+QUESTION_CACHE_TTL = int(os.environ.get("QUESTION_CACHE_TTL", 7 * 24 * 3600))
+QUESTION_CACHE_THRESHOLD = float(os.environ.get("QUESTION_CACHE_THRESHOLD", 0.8))
+QUESTION_CACHE_MAX_ENTRIES = int(os.environ.get("QUESTION_CACHE_MAX_ENTRIES", 500))
+QUESTION_CACHE_INDEX_REFRESH = 60  # 類似検索用の索引をプロセス内に持つ秒数
+# プロンプトが変わったら別のキーになり、古い回答は使われなくなる
+_question_cache_key = "question_cache:" + hashlib.sha256((question_prompt + question_input_prompt).encode('utf-8')).hexdigest()[:16]
+# 本人の状況や過去のやりとりについての質問は、履歴によって答えが変わるのでキャッシュしない
+_PERSONAL_QUESTION_PATTERN = re.compile(r"私|わたし|僕|ぼく|俺|自分|前回|さっき|先ほど|履歴|これまで|今まで")
+_question_index = {"loaded_at": 0.0, "entries": []}
+_question_index_lock = threading.Lock()
+
+def normalize_question(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"[\s。、.,!?「」『』()・…]+", "", text)
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+def _load_question_index():
+    now = time.time()
+    with _question_index_lock:
+        if now - _question_index["loaded_at"] < QUESTION_CACHE_INDEX_REFRESH:
+            return _question_index["entries"]
+        entries = []
+        for field, value in redis_client.hgetall(_question_cache_key).items():
+            record = json.loads(value)
+            if now - record["created"] < QUESTION_CACHE_TTL:
+                normalized = field.decode('utf-8')
+                entries.append((normalized, _bigrams(normalized), record["response"]))
+        _question_index["entries"] = entries
+        _question_index["loaded_at"] = now
+        return entries
+
+# ほかの Redis のキャッシュと同じく、読み書きに失敗してもキャッシュが無いものとして応答を続ける
+def lookup_question_cache(text):
+    normalized = normalize_question(text)
+    if not normalized or _PERSONAL_QUESTION_PATTERN.search(normalized):
+        return None, None
+    try:
+        value = redis_client.hget(_question_cache_key, normalized)
+        if value is not None:
+            record = json.loads(value)
+            if time.time() - record["created"] < QUESTION_CACHE_TTL:
+                return "exact", record["response"]
+        entries = _load_question_index()
+    except redis.RedisError as e:
+        logger.warning(f"Failed to read question cache: {e}")
+        return None, None
+
+    query = _bigrams(normalized)
+    best_score, best_response = 0.0, None
+    for _, grams, response in entries:
+        score = len(query & grams) / len(query | grams)
+        if score > best_score:
+            best_score, best_response = score, response
+    if best_score >= QUESTION_CACHE_THRESHOLD:
+        return "near", best_response
+    return None, None
+
+def store_question_cache(text, response):
+    normalized = normalize_question(text)
+    # 形式どおりに <response> で答えたものだけを残す
+    if not normalized or _PERSONAL_QUESTION_PATTERN.search(normalized) or "</response>" not in response:
+        return
+    try:
+        if redis_client.hlen(_question_cache_key) >= QUESTION_CACHE_MAX_ENTRIES:
+            return
+        with redis_client.pipeline() as pipe:
+            pipe.hset(_question_cache_key, normalized, json.dumps({"response": response, "created": time.time()}))
+            pipe.expire(_question_cache_key, QUESTION_CACHE_TTL)
+            pipe.execute()
+    except redis.RedisError as e:
+        # 応答は生成済みなので、保存できなくてもそのまま返す
+        logger.warning(f"Failed to store question cache: {e}")
+
+def _record_question_cache(tier):
+    increment_metric(f"question_cache_{tier or 'miss'}")
+    if tier:
+        # 節約できた時間は、キャッシュを使わなかったときの平均の応答時間で見積もる
+        saved = get_metric_mean("question_cache_miss_seconds")
+        if saved is not None:
+            observe_metric("question_cache_saved_seconds", saved)
+
+def _respond(topic, input, config):
+    if not (QUESTION_CACHE_ENABLED and "question" in topic.lower()):
+        return _run_branch(topic, input, config)
+
+    tier, cached = lookup_question_cache(input["input"])
+    _record_question_cache(tier)
+    if cached is not None:
+        return {"route": "question", "sys_prompt": question_prompt, "response": cached}
+    started = time.perf_counter()
+    result = _run_branch(topic, input, config)
+    observe_metric("question_cache_miss_seconds", time.perf_counter() - started)
+    store_question_cache(input["input"], result["response"])
+    return result
+
+async def _arespond(topic, input, config):
+    if not (QUESTION_CACHE_ENABLED and "question" in topic.lower()):
+        return await _arun_branch(topic, input, config)
+
+    tier, cached = await asyncio.to_thread(lookup_question_cache, input["input"])
+    _record_question_cache(tier)
+    if cached is not None:
+        return {"route": "question", "sys_prompt": question_prompt, "response": cached}
+    started = time.perf_counter()
+    result = await _arun_branch(topic, input, config)
+    observe_metric("question_cache_miss_seconds", time.perf_counter() - started)
+    await asyncio.to_thread(store_question_cache, input["input"], result["response"])
+    return result
+
+def _invoke_routed(input, config):
+    if ROUTER_MODE == "heuristic":
+        topic = classify_locally(input["input"])
+        if topic is None:
+            return "llm_fallback", _respond(get_chain_memory().invoke(input, config), input, config)
+        return f"local_{topic}", _respond(topic, input, config)
+
+    if ROUTER_MODE == "speculative":
+        speculation = _speculation_executor.submit(contextvars.copy_context().run, _respond, "other", input, config)
+        topic = get_chain_memory().invoke(input, config)
+        if "question" in topic.lower():
+            # まだ始まっていなければ取り消す。始まっている API 呼び出しは止められないので結果を捨てる
+            speculation.cancel()
+            return "speculation_discarded", _respond(topic, input, config)
+        return "speculation_used", speculation.result()
+
+    if not STREAM_RESPONSES and not QUESTION_CACHE_ENABLED:
+        return "llm", get_full_chain().invoke(input, config)
+    return "llm", _respond(get_chain_memory().invoke(input, config), input, config)
+
+async def _ainvoke_routed(input, config):
+    if ROUTER_MODE == "heuristic":
+        topic = classify_locally(input["input"])
+        if topic is None:
+            return "llm_fallback", await _arespond(await get_chain_memory().ainvoke(input, config), input, config)
+        return f"local_{topic}", await _arespond(topic, input, config)
+
+    if ROUTER_MODE == "speculative":
+        speculation = asyncio.create_task(_arespond("other", input, config))
+        topic = await get_chain_memory().ainvoke(input, config)
+        if "question" in topic.lower():
+            speculation.cancel()
+            return "speculation_discarded", await _arespond(topic, input, config)
+        return "speculation_used", await speculation
+
+    if not STREAM_RESPONSES and not QUESTION_CACHE_ENABLED:
+        return "llm", await get_full_chain().ainvoke(input, config)
+    return "llm", await _arespond(await get_chain_memory().ainvoke(input, config), input, config)
+
+def _record_routing(path, started):
+    increment_metric(f"router_path_{path}")
+    observe_metric("response_seconds", time.perf_counter() - started)
+
 ######### LangChainここまで #########
 def generate_claude_response(prompt, userId):
     config = _per_request_config_modifier({}, userId)  # 初期の config に userId を追加
@@ -489,12 +1645,41 @@ def generate_claude_response(prompt, userId):
     try:
         # # 履歴のデバッグログ
         # print("Debug: History before model invocation:", get_session_history(userId, userId).messages)
-        response = full_chain.invoke(input, config)
-        # logger.info(f"Response from GPT: {response}")
-        return response
+        # LangSmithによる追跡（プロジェクト名は環境変数ではなくこのリクエストのコンテキストにだけ設定する）
+        started = time.perf_counter()
+        with tracing_v2_enabled(project_name=f"lineREBT_{userId}"):
+            path, result = _invoke_routed(input, config)
+        _record_routing(path, started)
+        # logger.info(f"Response from GPT: {result['response']}")
+        return result
+    except Exception as e:
+        print(f"Error: {e}")
+        return {"route": None, "sys_prompt": None, "response": "Sorry, I couldn't understand that."}
+
+# 非同期版（asgi.py から使う）
+async def agenerate_claude_response(prompt, userId):
+    config = _per_request_config_modifier({}, userId)
+    input = {
+        "input": prompt,
+        "user_id": userId
+    }
+
+    try:
+        started = time.perf_counter()
+        with tracing_v2_enabled(project_name=f"lineREBT_{userId}"):
+            path, result = await _ainvoke_routed(input, config)
+        _record_routing(path, started)
+        return result
     except Exception as e:
         print(f"Error: {e}")
-        return "Sorry, I couldn't understand that."
+        return {"route": None, "sys_prompt": None, "response": "Sorry, I couldn't understand that."}
+
+# <response>タグの中身を抽出
+def extract_reply_text(full_response):
+    match = re.search(r'<response>(.*?)</response>', full_response, re.DOTALL)
+    if match:
+        return match.group(1)
+    return full_response
 
 
 # def generate_claude_response(prompt, userId):
@@ -530,129 +1715,441 @@ def generate_claude_response(prompt, userId):
 #         return "Sorry, I couldn't understand that."
 
         
+# 無料プランの回数制限のため、ユーザーごとの直近24時間の返信時刻を Redis のソート済みセットで数える
+# スコアは返信した時刻（UNIX 秒）。キャッシュが無いときだけ PostgreSQL から作り直す
+RATE_LIMIT_WINDOW_SECONDS = 86400
+
+def _reply_log_key(userId):
+    return f"reply_log:{userId}"
+
+# 窓より古いものを捨ててから数える。キーが無ければ -1 を返し、呼び出し側で作り直させる
+# 空のセットは Redis に残らないので、作り直し済みの目印として +inf の要素を1つ入れておく
+REPLY_LOG_COUNT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local since = tonumber(ARGV[1]) - tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. since)
+return redis.call('ZCOUNT', KEYS[1], since, '(+inf')
+"""
+
+# 作り直しは、まだ誰も作っていないときだけ行う
+REPLY_LOG_REBUILD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], '+inf', 'ready')
+for i = 2, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# キャッシュがあるときだけ追記する。無いときは次に数えるときに PostgreSQL から作り直す
+REPLY_LOG_RECORD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. (tonumber(ARGV[1]) - tonumber(ARGV[3])))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+_reply_log_count_script = redis_client.register_script(REPLY_LOG_COUNT_SCRIPT)
+
+# パイプラインの中でスクリプトを呼ぶと redis-py が実行前に SCRIPT EXISTS を別に送るので、
+# パイプラインで数えるときは同じ処理を普通のコマンドで積む（結果は EXISTS, ZREMRANGEBYSCORE, ZCOUNT の3つ）
+def queue_reply_log_count(pipe, userId, now):
+    key = _reply_log_key(userId)
+    since = now - RATE_LIMIT_WINDOW_SECONDS
+    pipe.exists(key)
+    pipe.zremrangebyscore(key, '-inf', f'({since}')
+    pipe.zcount(key, since, '(+inf')
+_reply_log_rebuild_script = redis_client.register_script(REPLY_LOG_REBUILD_SCRIPT)
+_reply_log_record_script = redis_client.register_script(REPLY_LOG_RECORD_SCRIPT)
+
+# 経過時間は DB の NOW() との差で求める（timestamp はタイムゾーン無しで保存しているため）
+REPLY_LOG_ROWS_QUERY = """
+SELECT id, EXTRACT(EPOCH FROM (NOW() - timestamp)) FROM line_bot_logs 
+WHERE sender='system' AND lineId=%s AND timestamp > NOW() - INTERVAL '24 HOURS';
+"""
+
+def reply_log_entries(rows, now):
+    args = [RATE_LIMIT_WINDOW_SECONDS]
+    for log_id, age in rows:
+        args.extend([now - float(age), f"log:{log_id}"])
+    return args
+
+def _count_system_responses_in_db(userId):
+    log_writer.flush(userId)
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            query = """
+            SELECT COUNT(*) FROM line_bot_logs 
+            WHERE sender='system' AND lineId=%s AND timestamp > NOW() - INTERVAL '24 HOURS';
+            """
+            cursor.execute(query, (userId,))
+            result = cursor.fetchone()
+            return result[0]
+        except Exception as e:
+            print(f"Error: {e}")
+            return 0
+        finally:
+            cursor.close()
+
+def _rebuild_reply_log(userId, now):
+    log_writer.flush(userId)
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(REPLY_LOG_ROWS_QUERY, (userId,))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    _reply_log_rebuild_script(keys=[_reply_log_key(userId)], args=reply_log_entries(rows, now))
+
 def get_system_responses_in_last_24_hours(userId):
-    # この関数の中でデータベースにアクセスして、指定されたユーザーに対する過去24時間以内のシステムの応答数を取得します。
-    # 以下は仮の実装の例です。
-    connection = get_connection()
-    cursor = connection.cursor()
+    # 指定されたユーザーに対する過去24時間以内のシステムの応答数を取得します。
+    key = _reply_log_key(userId)
+    now = time.time()
     try:
-        query = """
-        SELECT COUNT(*) FROM line_bot_logs 
-        WHERE sender='system' AND lineId=%s AND timestamp > NOW() - INTERVAL '24 HOURS';
-        """
-        cursor.execute(query, (userId,))
-        result = cursor.fetchone()
-        return result[0]
+        count = _reply_log_count_script(keys=[key], args=[now, RATE_LIMIT_WINDOW_SECONDS])
+        if count < 0:
+            increment_metric("reply_log_rebuilds")
+            _rebuild_reply_log(userId, now)
+            count = _reply_log_count_script(keys=[key], args=[now, RATE_LIMIT_WINDOW_SECONDS])
+        return count
     except Exception as e:
-        print(f"Error: {e}")
-        return 0
-    finally:
-        cursor.close()
-        connection.close()
+        logger.warning(f"Failed to read reply log from Redis, counting in the database: {e}")
+        return _count_system_responses_in_db(userId)
+
+def record_system_response(userId):
+    try:
+        _reply_log_record_script(keys=[_reply_log_key(userId)],
+                                 args=[time.time(), uuid4().hex, RATE_LIMIT_WINDOW_SECONDS])
+    except redis.RedisError as e:
+        # 記録に失敗したら、次に数えるときに PostgreSQL から作り直させる
+        logger.warning(f"Failed to record reply: {e}")
+        try:
+            redis_client.delete(_reply_log_key(userId))
+        except redis.RedisError:
+            pass
 
 def deactivate_conversation_history(userId):
     # logger.info(f"Attempting to deactivate conversation history for user: {userId}")
-    connection = get_connection()
-    cursor = connection.cursor()
+    log_writer.flush(userId)  # バッファに残っている行も無効にする
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            query = """
+            UPDATE line_bot_logs SET is_active=FALSE 
+            WHERE lineId=%s AND is_active=TRUE;
+            """
+            cursor.execute(query, (userId,))
+            cursor.execute("DELETE FROM conversation_summaries WHERE lineId=%s;", (userId,))
+            connection.commit()
+            RedisChatMessageHistory(userId).clear()
+            redis_client.delete(f"conversation_summary:{userId}", _summary_pending_key(userId))
+            set_user_state(userId, 'normal')  # ユーザーの状態をリセット
+        except Exception as e:
+            print(f"Error: {e}")
+            connection.rollback()
+        finally:
+            cursor.close()
+
+@timed("send_reply")
+def send_reply(event, reply_text):
+    message = TextSendMessage(text=reply_text)
     try:
-        query = """
-        UPDATE line_bot_logs SET is_active=FALSE 
-        WHERE lineId=%s;
-        """
-        cursor.execute(query, (userId,))
-        connection.commit()
-        set_user_state(userId, 'normal')  # ユーザーの状態をリセット
-    except Exception as e:
-        print(f"Error: {e}")
-        connection.rollback()
-    finally:
-        cursor.close()
-        connection.close()
+        line_bot_api.reply_message(event.reply_token, message)
+    except LineBotApiError as e:
+        # キュー経由で処理が遅れ、返信トークンの期限が切れていたら push で送る
+        user_id = getattr(event.source, 'user_id', None)
+        if e.status_code != 400 or not user_id:
+            raise
+        logger.info(f"Reply token rejected, falling back to push: {e}")
+        line_bot_api.push_message(user_id, message)
 
 # LINEからのメッセージを処理し、必要に応じてStripeの情報も確認します。
+@timed("get_user_state")
 def get_user_state(user_id):
     state = redis_client.get(f"user_state:{user_id}")
     return state.decode('utf-8') if state else 'normal'
 
+USER_STATE_TTL = 1800  # 30分後に期限切れ
+
 def set_user_state(user_id, state):
-    redis_client.set(f"user_state:{user_id}", state)
-    redis_client.expire(f"user_state:{user_id}", 1800)  # 30分後に期限切れ
+    redis_client.set(f"user_state:{user_id}", state, ex=USER_STATE_TTL)
+
+def _subscription_details(record):
+    if record is None:
+        return None
+    record = json.loads(record)
+    if record['status'] == 'canceled':
+        return None
+    return {
+        'status': record['status'],
+        'stripeId': record['stripeId']
+    }
+
+# 1件のメッセージの処理で読む Redis のキーは、1回のパイプラインでまとめて読む
+# 読めなかった値は入れずに返すので、呼び出し側はそれぞれの関数で読み直す
+@timed("load_message_context")
+def load_message_context(userId):
+    subscription_key = _subscription_index_key(STRIPE_PRICE_ID)
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(f"user_state:{userId}")
+            pipe.exists(f"{subscription_key}:fresh")
+            pipe.hget(subscription_key, userId)
+            queue_reply_log_count(pipe, userId, time.time())
+            pipe.lrange(f"chat_history:{userId}", 0, -1)
+            pipe.get(f"conversation_summary:{userId}")
+            state, subscription_fresh, subscription, reply_log_exists, _, reply_count, history, summary = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Failed to load message context: {e}")
+        return {}
+
+    context = {"state": state.decode('utf-8') if state else 'normal'}
+    if subscription_fresh:
+        context["subscription"] = _subscription_details(subscription)
+    if reply_log_exists:
+        context["reply_count"] = reply_count
+    if history:
+        context["history"] = [json.loads(item) for item in history]
+    if summary is not None:
+        context["summary"] = summary.decode('utf-8')
+    return context
+
+# 同じユーザーのメッセージは Redis のロックで1件ずつ順番に処理し、別のユーザーは並行して処理する
+USER_LOCK_TIMEOUT = int(os.environ.get("USER_LOCK_TIMEOUT", 180))  # LLMの応答待ちより長くしておく
+# 0より大きいと、この秒数のあいだに続けて届いた同じユーザーのメッセージを1回の応答にまとめる
+MESSAGE_COALESCE_SECONDS = float(os.environ.get("MESSAGE_COALESCE_SECONDS", 0))
+
+@contextmanager
+def user_lock(userId):
+    lock = redis_client.lock(f"user_lock:{userId}", timeout=USER_LOCK_TIMEOUT, blocking_timeout=USER_LOCK_TIMEOUT)
+    acquired = lock.acquire()
+    if not acquired:
+        logger.warning(f"Timed out waiting for user lock, processing anyway: {userId}")
+    try:
+        yield
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                pass  # 処理が長引いてロックの期限が切れていた
+
+# LINE は応答が遅いと同じイベントを再送するので、受け取ったイベントを Redis に覚えておき、2回目以降は捨てる
+WEBHOOK_DEDUPE_TTL = int(os.environ.get("WEBHOOK_DEDUPE_TTL", 86400))
+
+def webhook_event_key(event):
+    # webhookEventId は再送されても変わらない。取れないイベントはメッセージ ID で代わりにする
+    event_id = getattr(event, 'webhook_event_id', None)
+    if event_id:
+        return f"webhook_event:{event_id}"
+    message_id = getattr(getattr(event, 'message', None), 'id', None)
+    return f"webhook_message:{message_id}" if message_id else None
+
+def record_webhook_delivery(event, claimed):
+    if getattr(getattr(event, 'delivery_context', None), 'is_redelivery', False):
+        increment_metric("webhook_redeliveries")
+    if not claimed:
+        increment_metric("webhook_duplicate_events")
+        logger.info(f"Dropping duplicate webhook event: {webhook_event_key(event)}")
+
+def claim_webhook_event(event):
+    key = webhook_event_key(event)
+    if key is None:
+        return True
+    try:
+        claimed = bool(redis_client.set(key, 1, nx=True, ex=WEBHOOK_DEDUPE_TTL))
+    except redis.RedisError as e:
+        # 確かめられないときは処理する（返信しないよりは二重に返すほうがまし）
+        logger.warning(f"Failed to check webhook event: {e}")
+        return True
+    record_webhook_delivery(event, claimed)
+    return claimed
+
+def release_webhook_event(event):
+    key = webhook_event_key(event)
+    if key is None:
+        return
+    try:
+        redis_client.delete(key)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to release webhook event: {e}")
 
 @handler.add(MessageEvent, message=TextMessage)
-def handle_line_message(event):
-    global current_prompt
+def dispatch_line_event(event):
+    if not claim_webhook_event(event):
+        return
+    try:
+        _dispatch_line_event(event)
+    except Exception:
+        # 処理できなかったイベントは、再送されたときにやり直せるようにする
+        release_webhook_event(event)
+        raise
+
+# 1つの webhook に複数のユーザーのイベントが入っているときは、ユーザーごとに別スレッドで並行して処理する
+# 同じユーザーのイベントは届いた順に1つのスレッドで処理する。署名の確認とパースは呼び出し元のスレッドで1回だけ行う
+WEBHOOK_FANOUT_THREADS = int(os.environ.get("WEBHOOK_FANOUT_THREADS", 8))
+_event_executor = ThreadPoolExecutor(max_workers=WEBHOOK_FANOUT_THREADS, thread_name_prefix="line-event")
+
+def _handle_event(event):
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        dispatch_line_event(event)
+
+def _handle_events_in_order(events):
+    for event in events:
+        _handle_event(event)
+
+def handle_webhook(body, signature):
+    events = handler.parser.parse(body, signature)
+    groups = {}
+    for event in events:
+        userId = getattr(event.source, 'user_id', None)
+        groups.setdefault(userId or id(event), []).append(event)
+    if len(groups) <= 1:
+        for group in groups.values():
+            _handle_events_in_order(group)
+        return
+
+    observe_metric("webhook_fanout_users", len(groups))
+    futures = [_event_executor.submit(contextvars.copy_context().run, _handle_events_in_order, group)
+               for group in groups.values()]
+    # 1人の失敗でほかのユーザーの処理を止めないよう、全員の分を待ってから最初のエラーを伝える
+    error = None
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            logger.exception("Failed to handle LINE events")
+            error = error or e
+    if error is not None:
+        raise error
+
+def _dispatch_line_event(event):
     userId = getattr(event.source, 'user_id', None)
+    if not userId:
+        handle_line_message(event)
+        return
+
+    if MESSAGE_COALESCE_SECONDS <= 0 or event.message.text == "リセット":
+        with user_lock(userId):
+            handle_line_message(event)
+        return
+
+    # 状態は積むのと同じパイプラインで読み、別に問い合わせない
+    pending_key = f"pending_messages:{userId}"
+    with redis_client.pipeline() as pipe:
+        pipe.get(f"user_state:{userId}")
+        pipe.rpush(pending_key, event.message.text)
+        pipe.expire(pending_key, USER_LOCK_TIMEOUT)
+        state, _, _ = pipe.execute()
+    if state and state.decode('utf-8') != 'normal':
+        # リセットの確認中のやりとりはまとめずに、そのまま順番に処理する
+        redis_client.lrem(pending_key, 1, event.message.text)
+        with user_lock(userId):
+            handle_line_message(event)
+        return
+    time.sleep(MESSAGE_COALESCE_SECONDS)
+
+    with user_lock(userId):
+        with redis_client.pipeline() as pipe:
+            pipe.lrange(pending_key, 0, -1)
+            pipe.delete(pending_key)
+            texts, _ = pipe.execute()
+        if not texts:
+            return  # 先に処理されたイベントがこのメッセージもまとめて返信済み
+        handle_line_message(event, "\n".join(t.decode('utf-8') for t in texts))
+
+@timed("handle_line_message")
+@request_history_scope()
+def handle_line_message(event, text=None):
+    userId = getattr(event.source, 'user_id', None)
+    if text is None:
+        text = event.message.text
     
     if not userId:
         reply_text = "エラーが発生しました。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        send_reply(event, reply_text)
         return
 
-    current_state = get_user_state(userId)
+    context = load_message_context(userId)
+    current_state = context["state"] if "state" in context else get_user_state(userId)
 
     # ユーザーが「リセット」を送信した場合
-    if event.message.text == "リセット":
+    if text == "リセット":
         set_user_state(userId, 'awaiting_reset_confirmation')
         reply_text = "過去の対話履歴を削除して良いですか？一度削除すると元には戻せません。よろしければ「はい」と入力してください。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        send_reply(event, reply_text)
         return
 
     # ユーザーが「はい」を送信した場合、リセット確認状態なら履歴を削除
     elif current_state == 'awaiting_reset_confirmation':
-        if event.message.text.lower() == "はい":
+        if text.lower() == "はい":
             deactivate_conversation_history(userId)
             reply_text = "対話履歴を削除しました。"
         else:
             reply_text = "対話履歴の削除を中止しました。"
         set_user_state(userId, 'normal')
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        send_reply(event, reply_text)
         return
 
     # 通常のメッセージ処理
     current_timestamp = datetime.now()
 
-    if userId:
-        # LangSmithによる追跡
-        os.environ["LANGCHAIN_API_KEY"]
-        os.environ["LANGCHAIN_TRACING_V2"] = "true"
-        LANGCHAIN_ENDPOINT="https://api.smith.langchain.com"
-        os.environ["LANGCHAIN_PROJECT"] = f"lineREBT_{userId}"
-        
+    if "subscription" in context:
+        subscription_details = context["subscription"]
+    else:
         subscription_details = get_subscription_details_for_user(userId, STRIPE_PRICE_ID)
-        stripe_id = subscription_details['stripeId'] if subscription_details else None
-        subscription_status = subscription_details['status'] if subscription_details else None
-
-        log_to_database(current_timestamp, 'user', userId, stripe_id, event.message.text, current_prompt, model_name, True)
-
-        if subscription_status == None: ####################本番は"active", テストはNone################
-            full_response = generate_claude_response(event.message.text, userId)
-            # <response>タグの中身を抽出
-            match = re.search(r'<response>(.*?)</response>', full_response, re.DOTALL)
-            if match:
-                reply_text = match.group(1)
-            else:
-                reply_text = full_response
-        else:
-            response_count = get_system_responses_in_last_24_hours(userId)
-            if response_count < 5: 
-                full_response = generate_claude_response(event.message.text, userId)
-                # <response>タグの中身を抽出
-                match = re.search(r'<response>(.*?)</response>', full_response, re.DOTALL)
-                if match:
-                    reply_text = match.group(1)
-                else:
-                    reply_text = full_response
-            else:
-                line_login_url = os.environ["LINE_LOGIN_URL"]
-                reply_text = f"利用回数の上限に達しました。24時間後に再度お試しください。こちらから回数無制限の有料プランに申し込むこともできます：{line_login_url}"
+    stripe_id = subscription_details['stripeId'] if subscription_details else None
+    subscription_status = subscription_details['status'] if subscription_details else None
+
+    # 使うプロンプトはルーティングが終わるまで決まらないので、ユーザーの発言のDBへの記録は応答と一緒に行う
+    # （今回の発言はチェーンに input として渡すので、履歴には含めない）
+    # パイプラインで読めた履歴と要約はそのまま使い、無ければここで1回だけ読み込む
+    cache = _request_history.get()
+    if "history" in context:
+        cache[userId] = context["history"]
+    if "summary" in context:
+        cache[("summary", userId)] = context["summary"]
+    get_session_history(userId)
+
+    result = None
+    if subscription_status == None: ####################本番は"active", テストはNone################
+        result = generate_claude_response(text, userId)
     else:
-        reply_text = "エラーが発生しました。"
+        response_count = context.get("reply_count")
+        if response_count is None:
+            response_count = get_system_responses_in_last_24_hours(userId)
+        if response_count < 5: 
+            result = generate_claude_response(text, userId)
+        else:
+            line_login_url = os.environ["LINE_LOGIN_URL"]
+            reply_text = f"利用回数の上限に達しました。24時間後に再度お試しください。こちらから回数無制限の有料プランに申し込むこともできます：{line_login_url}"
 
-    # メッセージをログに保存
-    log_to_database(current_timestamp, 'system', userId, stripe_id, full_response, current_prompt, model_name, True)
+    # 返信を先に送り、ログの保存はその後に行う
+    if result:
+        reply_text = extract_reply_text(result["response"])
+    try:
+        send_reply(event, reply_text)
+    finally:
+        # メッセージをログに保存（返信に失敗しても記録は残す）
+        sys_prompt = result["sys_prompt"] if result else None
+        # フェイルオーバーやヘッジで別のプロバイダが答えた場合も、実際に答えたモデルを記録する
+        response_model = result.get("model", model_name) if result else model_name
+        log_to_database(current_timestamp, 'user', userId, stripe_id, text, sys_prompt, response_model, True)
+        if result:
+            log_to_database(current_timestamp, 'system', userId, stripe_id, result["response"], sys_prompt, response_model, True)
+            record_system_response(userId)
 
-    # 最終的な返信メッセージを送信
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    schedule_summary_update(userId)
 
 
 # # LINEからのメッセージを処理し、必要に応じてStripeの情報も確認します。
@@ -745,37 +2242,288 @@ def handle_line_message(event):
 #         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
 
 # stripeの情報を参照
-def get_subscription_details_for_user(userId, STRIPE_PRICE_ID):
-    subscriptions = stripe.Subscription.list(limit=100)
-    for subscription in subscriptions.data:
-        if subscription["items"]["data"][0]["price"]["id"] == STRIPE_PRICE_ID and subscription["metadata"].get("line_user") == userId:
+# 毎回 Stripe に問い合わせず、LINEユーザーID -> サブスクリプションの索引を Redis のハッシュに持つ
+SUBSCRIPTION_INDEX_TTL = int(os.environ.get("SUBSCRIPTION_INDEX_TTL", 300))  # この秒数ごとに Stripe から作り直す
+SUBSCRIPTION_INDEX_WAIT = float(os.environ.get("SUBSCRIPTION_INDEX_WAIT", 10))  # 初回の作り直しを別のワーカーが行っているときに待つ秒数
+# 設定するとStripeの代わりにこのJSONファイル（サブスクリプションの配列）を読む。ローカル検証用
+SUBSCRIPTION_FIXTURE_PATH = os.environ.get("SUBSCRIPTION_FIXTURE_PATH")
+
+def _subscription_index_key(price_id):
+    return f"subscription_index:{price_id}"
+
+# 索引の1ユーザー分を書き換える。既にあるレコードより古い情報（as_of が小さい）は捨てるので、
+# webhook の順序が前後しても、同じイベントが再送されても結果は変わらない
+# 解約済み（canceled）のレコードは削除では消さない。Stripe の一覧には解約済みが出てこないので、
+# 作り直しで消してしまうと、後から届いた解約前の updated イベントで有効な状態に戻ってしまう
+# KEYS[1]: 索引, ARGV[1]: LINEユーザーID, ARGV[2]: レコードのJSON（空文字なら削除）, ARGV[3]: as_of
+_upsert_subscription_script = redis_client.register_script("""
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current then
+    local ok, decoded = pcall(cjson.decode, current)
+    if ok and tonumber(decoded['as_of']) > tonumber(ARGV[3]) then
+        return 0
+    end
+    if ok and ARGV[2] == '' and decoded['status'] == 'canceled' then
+        return 0
+    end
+end
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+return 1
+""")
+
+def _iter_subscriptions(price_id):
+    if SUBSCRIPTION_FIXTURE_PATH:
+        with open(SUBSCRIPTION_FIXTURE_PATH, encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+    # 100件を超えてもページングで全件たどる
+    yield from stripe.Subscription.list(price=price_id, limit=100).auto_paging_iter()
+
+def refresh_subscription_index(price_id):
+    as_of = time.time()
+    records = {}
+    for subscription in _iter_subscriptions(price_id):
+        if subscription["items"]["data"][0]["price"]["id"] != price_id:
+            continue
+        line_user = subscription["metadata"].get("line_user")
+        # 一覧は新しい順なので、同じユーザーの最初の1件を採用する
+        if line_user and line_user not in records:
+            records[line_user] = json.dumps({
+                'status': subscription["status"],
+                'stripeId': subscription["customer"],
+                'as_of': as_of,
+            })
+
+    # 作り直しの間に webhook で届いた新しい状態は上書きしない
+    key = _subscription_index_key(price_id)
+    stale_users = [field.decode('utf-8') for field in redis_client.hkeys(key)]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for line_user, record in records.items():
+            _upsert_subscription_script(keys=[key], args=[line_user, record, as_of], client=pipe)
+        for line_user in stale_users:
+            if line_user not in records:
+                _upsert_subscription_script(keys=[key], args=[line_user, '', as_of], client=pipe)
+        pipe.set(f"{key}:fresh", as_of, ex=SUBSCRIPTION_INDEX_TTL)
+        # 加入者が0人だとハッシュ自体が Redis に残らないので、一度作ったことは別のキーで覚えておく
+        pipe.set(f"{key}:built", as_of)
+        pipe.execute()
+    logger.info(f"Subscription index rebuilt with {len(records)} entries")
+
+def _refresh_subscription_index_locked(price_id):
+    key = _subscription_index_key(price_id)
+    # 複数ワーカーが同時に作り直さないようにロックを取る。取れなければ今ある索引をそのまま使う
+    if not redis_client.set(f"{key}:lock", 1, nx=True, ex=60):
+        return
+    try:
+        refresh_subscription_index(price_id)
+    except Exception as e:
+        logger.error(f"Failed to rebuild subscription index: {e}")
+    finally:
+        redis_client.delete(f"{key}:lock")
+
+def _ensure_subscription_index(price_id):
+    """索引を使える状態にする。一度も作られておらず、待っても作れなかったときだけ False を返す。"""
+    key = _subscription_index_key(price_id)
+    if redis_client.exists(f"{key}:fresh"):
+        return True
+    if redis_client.exists(f"{key}:built"):
+        # 索引はあるが古い場合は、応答を待たせずに裏で作り直す
+        threading.Thread(target=_refresh_subscription_index_locked, args=(price_id,), daemon=True).start()
+        return True
+
+    # 初回だけは索引が無いので同期的に作る。ほかのワーカーが作っている最中なら、それが終わるのを待つ
+    _refresh_subscription_index_locked(price_id)
+    deadline = time.monotonic() + SUBSCRIPTION_INDEX_WAIT
+    while not redis_client.exists(f"{key}:built"):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
+def _find_subscription_in_stripe(userId, price_id):
+    # 索引が使えないときだけ、以前と同じく Stripe の一覧から直接探す（有料の利用者を無料扱いにしないため）
+    for subscription in _iter_subscriptions(price_id):
+        if subscription["items"]["data"][0]["price"]["id"] == price_id and subscription["metadata"].get("line_user") == userId:
             return {
                 'status': subscription["status"],
                 'stripeId': subscription["customer"]
             }
     return None
 
+@timed("get_subscription_details_for_user")
+def get_subscription_details_for_user(userId, STRIPE_PRICE_ID):
+    if not _ensure_subscription_index(STRIPE_PRICE_ID):
+        return _find_subscription_in_stripe(userId, STRIPE_PRICE_ID)
+    return _subscription_details(redis_client.hget(_subscription_index_key(STRIPE_PRICE_ID), userId))
+
+# Stripe の customer.subscription.* イベントで索引を更新する
+def apply_subscription_event(event):
+    if not event["type"].startswith("customer.subscription."):
+        return False
+    processed_key = f"stripe_event:{event['id']}"
+    if redis_client.exists(processed_key):
+        return False
+
+    subscription = event["data"]["object"]
+    line_user = subscription["metadata"].get("line_user")
+    if line_user and subscription["items"]["data"][0]["price"]["id"] == STRIPE_PRICE_ID:
+        # 解約済みも削除せずに残しておき、後から届いた古い updated イベントで復活しないようにする
+        status = 'canceled' if event["type"] == "customer.subscription.deleted" else subscription["status"]
+        record = json.dumps({
+            'status': status,
+            'stripeId': subscription["customer"],
+            'as_of': event["created"],
+        })
+        applied = _upsert_subscription_script(keys=[_subscription_index_key(STRIPE_PRICE_ID)], args=[line_user, record, event["created"]])
+        if not applied:
+            logger.info(f"Ignored out-of-order Stripe event {event['id']}")
+
+    redis_client.set(processed_key, 1, ex=7 * 24 * 3600)
+    return True
+
 # Stripeの情報を確認する関数
 def check_subscription_status(userId):
     return get_subscription_details_for_user(userId, STRIPE_PRICE_ID)
 
 # データをdbに入れる関数
+# システムプロンプトは内容のハッシュをキーに prompts テーブルへ1度だけ保存し、ログには prompt_id だけを残す
+_prompt_ids = {}
+
+def prompt_hash(sys_prompt):
+    return hashlib.sha256(sys_prompt.encode('utf-8')).hexdigest()
+
+def get_prompt_id(cursor, sys_prompt):
+    digest = prompt_hash(sys_prompt)
+    prompt_id = _prompt_ids.get(digest)
+    if prompt_id is None:
+        # DO UPDATE にしているのは、既にある行でも RETURNING で id を返させるため
+        cursor.execute("""
+        INSERT INTO prompts (hash, content) VALUES (%s, %s)
+        ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash
+        RETURNING id;
+        """, (digest, sys_prompt))
+        prompt_id = cursor.fetchone()[0]
+    return digest, prompt_id
+
+# line_bot_logs への書き込みは LogWriter がまとめて行う
+# 件数（LOG_BATCH_SIZE）か時間（LOG_FLUSH_INTERVAL 秒）のどちらかに達したら、複数行の INSERT で書き出す
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 50))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 0.5))
+
+class LogWriter:
+    """ログの行をバッファに積み、バックグラウンドのスレッドでまとめて書き出す。
+
+    PostgreSQL から履歴などを読む前には flush(userId) を呼び、そのユーザーの行を先に書き出す。
+    """
+
+    def __init__(self, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._cond = threading.Condition()
+        # 書き出し中の行はバッファから消えているので、flush はそれが終わるのも待つ必要がある
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def write(self, row):
+        with self._cond:
+            if not self._closed:
+                self._rows.append(row)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                    self._thread.start()
+                if len(self._rows) >= self.batch_size:
+                    self._cond.notify()
+                return
+        # 終了処理の後に来た行はその場で書く
+        self._write([row])
+
+    def flush(self, userId=None):
+        with self._flush_lock:
+            with self._cond:
+                if userId is not None and all(row[2] != userId for row in self._rows):
+                    return
+                rows, self._rows = self._rows, []
+            if not rows:
+                return
+            try:
+                self._write(rows)
+            except Exception:
+                # プールからコネクションを取れなかったときなどは、次の機会に書き出す
+                with self._cond:
+                    self._rows[:0] = rows
+                raise
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._rows) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            if closed:
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush log rows")
+
+    def _write(self, rows):
+        started = time.perf_counter()
+        failed = False
+        with db_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                prompt_ids = {}
+                values = []
+                for timestamp, sender, userId, stripeId, message, is_active, sys_prompt, model_name in rows:
+                    if sys_prompt and sys_prompt not in prompt_ids:
+                        prompt_ids[sys_prompt] = get_prompt_id(cursor, sys_prompt)
+                    prompt_id = prompt_ids[sys_prompt][1] if sys_prompt else None
+                    values.append((timestamp, sender, userId, stripeId, message, is_active, prompt_id, model_name))
+                execute_values(cursor, """
+                INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, prompt_id, model) 
+                VALUES %s;
+                """, values)
+                connection.commit()
+                # コミット前に覚えると、ロールバックされた id を使い回してしまう
+                _prompt_ids.update(prompt_ids.values())
+            except Exception as e:
+                print(f"Error: {e}")
+                connection.rollback()
+                failed = True
+            finally:
+                cursor.close()
+        if failed and len(rows) > 1:
+            # 1行の不具合でまとめて失われないように、1行ずつ書き直す
+            for row in rows:
+                self._write([row])
+            return
+        observe_metric("log_flush_seconds", time.perf_counter() - started)
+        observe_metric("log_flush_rows", len(rows))
+
+log_writer = LogWriter()
+# atexit は登録と逆順に呼ばれるので、DB プールを閉じる前に残りの行を書き出せる
+atexit.register(log_writer.close)
+
+@timed("log_to_database")
 def log_to_database(timestamp, sender, userId, stripeId, message, sys_prompt, model_name=None, is_active=True):
-    connection = get_connection()
-    cursor = connection.cursor()
-    try:
-        query = """
-        INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, sys_prompt, model) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-        """
-        cursor.execute(query, (timestamp, sender, userId, stripeId, message, is_active, sys_prompt, model_name))
-        connection.commit()
-    except Exception as e:
-        print(f"Error: {e}")
-        connection.rollback()
-    finally:
-        cursor.close()
-        connection.close()
+    log_writer.write((timestamp, sender, userId, stripeId, message, is_active, sys_prompt, model_name))
+    # Redis の履歴にはすぐ積むので、次のターンの履歴は書き出しを待たずに読める
+    if is_active:
+        RedisChatMessageHistory(userId).add_message(_message_from_row(sender, message))
 
 # # 会話履歴を参照する関数
 # def get_conversation_history(userId):
@@ -1034,3 +2782,56 @@ def log_to_database(timestamp, sender, userId, stripeId, message, sys_prompt, mo
 # if __name__ == "__main__":
 #     port = int(os.getenv("PORT", 5000))
 #     app.run(host="0.0.0.0", port=port)
+
+# キューに積まれた webhook を処理するワーカー
+def _webhook_worker():
+    while True:
+        try:
+            item = redis_client.brpop(WEBHOOK_QUEUE_KEY, timeout=1)
+        except redis.RedisError as e:
+            logger.error(f"Failed to read webhook queue: {e}")
+            time.sleep(1)
+            continue
+        if item is None:
+            continue
+
+        job = json.loads(item[1])
+        observe_metric("webhook_queue_wait_seconds", time.time() - job["enqueued_at"])
+        started = time.perf_counter()
+        try:
+            handle_webhook(job["body"], job["signature"])
+        except Exception:
+            logger.exception("Failed to process queued webhook")
+        observe_metric("webhook_processing_seconds", time.perf_counter() - started)
+
+def start_webhook_workers():
+    for i in range(WEBHOOK_WORKER_THREADS):
+        threading.Thread(target=_webhook_worker, name=f"webhook-worker-{i}", daemon=True).start()
+
+def ready():
+    # 依存先に繋がるかを確かめ、チェーンも作っておく（最初のメッセージで待たせないため）
+    try:
+        redis_client.ping()
+        with db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        get_full_chain()
+        get_summary_chain()
+    except Exception as e:
+        logger.warning(f"Not ready: {e}")
+        return "not ready", 503
+    return "ready"
+
+def metrics():
+    return render_prometheus_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+def create_app():
+    app = Flask(__name__)
+    app.add_url_rule("/", view_func=hello_world)
+    app.add_url_rule("/ready", view_func=ready)
+    app.add_url_rule("/metrics", view_func=metrics)
+    app.add_url_rule("/callback", view_func=callback, methods=['POST'])
+    app.add_url_rule("/stripe/webhook", view_func=stripe_webhook, methods=['POST'])
+    if WEBHOOK_ASYNC:
+        start_webhook_workers()
+    return app
@@ -0,0 +1,83 @@
+# fixtures/ にある Stripe の customer.subscription.* イベントを apply_subscription_event に順に流し、
+# サブスクリプションのインデックスが期待どおりになるかを確かめる（作成・更新・解約・順序の入れ替わり・同じ id の再送）
+# ローカルの Redis を使う。キーはフィクスチャ用の price id と evt_fixture_* の id だけに書き込み、毎回消してから流す
+# {"refresh": [...]} の行では、その配列を Stripe の一覧の代わりにして refresh_subscription_index を実行する
+# 実行例: REDIS_URL=redis://localhost:6379 python replay_subscription_events.py
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from benchmark_import_time import REQUIRED_ENV
+
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "stripe_subscription_events.json")
+
+def load_fixture(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def reset_keys(main, price_id, scenario):
+    index_key = main._subscription_index_key(price_id)
+    keys = [index_key, f"{index_key}:fresh"]
+    keys += [f"stripe_event:{event['id']}" for event in scenario["events"] if "id" in event]
+    main.redis_client.delete(*keys)
+
+def refresh(main, price_id, subscriptions):
+    with tempfile.NamedTemporaryFile("w", suffix=".json", encoding="utf-8", delete=False) as f:
+        json.dump(subscriptions, f)
+    main.SUBSCRIPTION_FIXTURE_PATH = f.name
+    try:
+        main.refresh_subscription_index(price_id)
+    finally:
+        main.SUBSCRIPTION_FIXTURE_PATH = None
+        os.remove(f.name)
+
+def replay(main, price_id, scenario):
+    reset_keys(main, price_id, scenario)
+    results = []
+    for event in scenario["events"]:
+        if "refresh" in event:
+            refresh(main, price_id, event["refresh"])
+            results.append(None)
+        else:
+            results.append(main.apply_subscription_event(event))
+    errors = []
+    if results != scenario["expected_results"]:
+        errors.append(f"results {results} != {scenario['expected_results']}")
+    key = main._subscription_index_key(price_id)
+    for line_user, expected in scenario["expected_index"].items():
+        raw = main.redis_client.hget(key, line_user)
+        actual = None
+        if raw is not None:
+            record = json.loads(raw)
+            actual = {"status": record["status"], "stripeId": record["stripeId"]}
+        if actual != expected:
+            errors.append(f"{line_user}: {actual} != {expected}")
+    reset_keys(main, price_id, scenario)
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixture", default=DEFAULT_FIXTURE)
+    args = parser.parse_args()
+
+    fixture = load_fixture(args.fixture)
+    for key, value in REQUIRED_ENV.items():
+        os.environ.setdefault(key, value)
+    # インデックスのキーが本番の price id と重ならないよう、フィクスチャの price id で import する
+    os.environ["SUBSCRIPTION_PRICE_ID"] = fixture["price_id"]
+    import main as app
+
+    failed = 0
+    for scenario in fixture["scenarios"]:
+        errors = replay(app, fixture["price_id"], scenario)
+        print(f"{'FAIL' if errors else 'ok':4} {scenario['name']}")
+        for error in errors:
+            print(f"     {error}")
+        failed += bool(errors)
+    print(f"{len(fixture['scenarios']) - failed}/{len(fixture['scenarios'])} scenarios passed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())